@@ -0,0 +1,363 @@
+'''
+Benchmarks for comparing alternative implementations of engine
+internals. Run with: python bench.py [name ...]
+'''
+
+import sys
+from contextlib import redirect_stdout
+from io import StringIO
+from random import Random
+from time import perf_counter as time
+
+from defs import *
+from perft import *
+from position import *
+from pseudothread import SharedMemory
+from search_data import SearchData
+from transposition import make_tt, DEFAULT_MB
+from evaluate import evaluate
+from magic import BISHOP_MAGICS, ROOK_MAGICS, magic_table
+import movegen
+import movepick
+import nnue
+import position
+import search
+
+BENCH_FENS = (
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -',
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq -',
+    'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - -',
+    'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP1B1PPP/R2QKB1R w KQ -',
+    '2r2rk1/1bqnbppp/p2ppn2/1p6/3NP3/1BN1BP2/PPPQ2PP/2KR3R w - -',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - -',
+)
+
+def report(label: str, nodes: int, seconds: float) -> None:
+    print(f'{label:<24}'
+          f'nodes {nodes:<10}'
+          f'time {round(seconds * 1e3):<8}'
+          f'nps {round(nodes / seconds)}')
+
+def bench_perft(depth: int=3, make_unmake: bool=False,
+                pseudo_legal: bool=False) -> tuple[int, float]:
+    '''Perft over the bench positions.'''
+
+    nodes = 0
+    start = time()
+
+    for fen in BENCH_FENS:
+        nodes += perft(parse_fen(fen), depth, make_unmake, pseudo_legal)
+
+    return nodes, time() - start
+
+def bench_search(depth: int=6) -> tuple[int, float]:
+    '''Single threaded fixed depth search over the bench positions.'''
+
+    shared = SharedMemory()
+    shared.tt = make_tt(DEFAULT_MB)
+    shared.set_limits(depth, 0, 0, 0, 0)
+    search.init_thread(0, shared)
+
+    nodes = 0
+    seconds = 0
+
+    for fen in BENCH_FENS:
+        shared.set_pos(parse_fen(fen))
+        shared.search_flag.value = True
+        shared.nodes.value = 0
+        start = time()
+        with redirect_stdout(StringIO()):
+            search.search(shared, SearchData())
+        seconds += time() - start
+        nodes += shared.nodes.value
+
+    return nodes, seconds
+
+def bench_make_unmake() -> None:
+    '''Copy/make against make/unmake.'''
+
+    for make_unmake in (False, True):
+        label = 'make/unmake' if make_unmake else 'copy/make'
+        report(f'perft {label}', *bench_perft(3, make_unmake))
+
+    for make_unmake in (False, True):
+        label = 'make/unmake' if make_unmake else 'copy/make'
+        search.set_make_unmake(make_unmake)
+        report(f'search {label}', *bench_search())
+
+    search.set_make_unmake(False)
+
+def bench_pseudo_legal() -> None:
+    '''Legal move generation against pseudo-legal with lazy checks.'''
+
+    for pseudo_legal in (False, True):
+        label = 'pseudo-legal' if pseudo_legal else 'legal'
+        report(f'perft {label}', *bench_perft(3, False, pseudo_legal))
+
+    for pseudo_legal in (False, True):
+        label = 'pseudo-legal' if pseudo_legal else 'legal'
+        search.set_pseudo_legal(pseudo_legal)
+        report(f'search {label}', *bench_search())
+
+    search.set_pseudo_legal(False)
+
+# Threshold SEE positions with x-rays opened by the first move: fen, move,
+# threshold and expected result
+SEE_TESTS = (
+    # Pushed pawn defended by the rook behind it
+    ('6k1/8/5n2/8/8/4P3/8/4R1K1 w - - 0 1', 'e3e4', 0, True),
+    ('6k1/8/5n2/8/8/4P3/8/6K1 w - - 0 1', 'e3e4', 0, False),
+    # En passant clears the file between the rook and the capture square
+    ('6k1/6n1/8/3Pp3/8/8/8/4R1K1 w - e6 0 1', 'd5e6', 100, True),
+    ('6k1/6n1/8/3Pp3/8/8/8/6K1 w - e6 0 1', 'd5e6', 100, False),
+)
+
+def bench_see(repeat: int=200) -> None:
+    '''SEE calls per node, and the full swap list against threshold SEE.'''
+
+    for fen, move_str, threshold, expected in SEE_TESTS:
+        pos = parse_fen(fen)
+        move, = [move for move in gen_perft(pos)
+                 if move_to_str(move) == move_str]
+        assert movepick.see_ge(pos, move, threshold) is expected, fen
+
+    see = movepick.see
+    see_ge = movepick.see_ge
+    calls = 0
+
+    def counted_see(pos: Position, move: Move) -> Value:
+        nonlocal calls
+        calls += 1
+        return see(pos, move)
+
+    def counted_see_ge(pos: Position, move: Move, threshold: Value) -> bool:
+        nonlocal calls
+        calls += 1
+        return see_ge(pos, move, threshold)
+
+    # Search prunes with its own reference to see_ge
+    movepick.see = counted_see
+    movepick.see_ge = search.see_ge = counted_see_ge
+    try:
+        nodes, seconds = bench_search()
+        report('search', nodes, seconds)
+        print(f'{"":<24}see calls {calls:<6}'
+              f'per node {calls / nodes:.2f}')
+    finally:
+        movepick.see = see
+        movepick.see_ge = search.see_ge = see_ge
+
+    # Every legal move of the bench positions against a zero threshold
+    tests = []
+    for fen in BENCH_FENS:
+        pos = parse_fen(fen)
+        tests += [(pos, move) for move in gen_perft(pos)]
+
+    start = time()
+    for _ in range(repeat):
+        for pos, move in tests:
+            see(pos, move) >= 0
+    report('see', repeat * len(tests), time() - start)
+
+    start = time()
+    for _ in range(repeat):
+        for pos, move in tests:
+            see_ge(pos, move, 0)
+    report('see_ge', repeat * len(tests), time() - start)
+
+def bench_nnue(repeat: int=20) -> None:
+    '''Evaluations and accumulator updates of the NNUE backends.'''
+
+    for backend in NNUE_BACKENDS:
+        try:
+            nnue.set_nnue_backend(backend)
+        except ImportError:
+            print(f'{backend:<24}not available')
+            continue
+
+        # Every legal move of the bench positions
+        positions = []
+        for fen in BENCH_FENS:
+            pos = parse_fen(fen)
+            refresh_accumulator(pos)
+            positions += [(pos, move) for move in gen_perft(pos)]
+        # Fresh children each time, so every evaluation also applies the
+        # accumulator update its move left pending
+        children = [do_move(pos, move)
+                    for _ in range(repeat) for pos, move in positions]
+
+        start = time()
+        for pos in children:
+            evaluate(pos)
+        report(f'{backend} evaluate', len(children), time() - start)
+
+        start = time()
+        for _ in range(repeat):
+            for pos, move in positions:
+                do_move(pos, move)
+        report(f'{backend} do_move', repeat * len(positions), time() - start)
+
+    nnue.set_nnue_backend(DEFAULT_NNUE_BACKEND)
+
+def rebuild_accumulator(pos: Position) -> None:
+    '''Builds the accumulator from every piece, without the refresh table.'''
+
+    pos.accumulator = Accumulator(None, (), (), [
+        nnue.backend_make_accumulation(color, pos.board, pos.occupied)
+        for color in (WHITE, BLACK)
+    ])
+
+def bench_refresh(count: int=2000, seed: int=0, repeat: int=10) -> None:
+    '''
+    Full accumulator builds against the refresh table, for unrelated
+    positions and for the positions of whole games in order. Each is
+    timed over its fastest of repeat passes.
+    '''
+
+    rng = Random(seed)
+
+    # Unrelated positions from random games out of the bench positions
+    unrelated = []
+    for _ in range(count):
+        pos = parse_fen(rng.choice(BENCH_FENS))
+        for _ in range(rng.randrange(40)):
+            moves = gen_perft(pos)
+            if not moves:
+                break
+            pos = do_move(pos, rng.choice(moves))
+        unrelated.append(pos)
+
+    # Every position of random games
+    games = []
+    while len(games) < count:
+        pos = parse_fen(rng.choice(BENCH_FENS))
+        for _ in range(80):
+            moves = gen_perft(pos)
+            if not moves:
+                break
+            pos = do_move(pos, rng.choice(moves))
+            games.append(pos)
+    games = games[:count]
+
+    for backend in NNUE_BACKENDS:
+        try:
+            nnue.set_nnue_backend(backend)
+        except ImportError:
+            print(f'{backend:<24}not available')
+            continue
+
+        for label, positions in (('unrelated', unrelated), ('games', games)):
+            rebuild_seconds = refresh_seconds = float('inf')
+
+            for _ in range(repeat):
+                start = time()
+                for pos in positions:
+                    rebuild_accumulator(pos)
+                rebuild_seconds = min(rebuild_seconds, time() - start)
+
+                start = time()
+                for pos in positions:
+                    pos.accumulator = None
+                    refresh_accumulator(pos)
+                refresh_seconds = min(refresh_seconds, time() - start)
+
+            report(f'{backend} {label} rebuild', count, rebuild_seconds)
+            report(f'{backend} {label} refresh', count, refresh_seconds)
+
+    nnue.set_nnue_backend(DEFAULT_NNUE_BACKEND)
+
+def bench_squares(repeat: int=20) -> None:
+    '''Square iteration with msb/xor loops against squares().'''
+
+    # Bitboards that move generation iterates over in a perft, empty ones
+    # included
+    bitboards = []
+    def record(bb: Bitboard) -> tuple[Square, ...]:
+        bitboards.append(bb)
+        return squares(bb)
+    movegen.squares = position.squares = record
+    try:
+        bench_perft(2)
+    finally:
+        movegen.squares = position.squares = squares
+
+    start = time()
+    count = 0
+    for _ in range(repeat):
+        for bb in bitboards:
+            while bb:
+                square = msb(bb)
+                bb ^= 1 << square
+                count += 1
+    report('msb loop', count, time() - start)
+
+    start = time()
+    count = 0
+    for _ in range(repeat):
+        for bb in bitboards:
+            for square in squares(bb):
+                count += 1
+    report('squares', count, time() - start)
+
+    report('perft', *bench_perft(3))
+
+def bench_sliders(repeat: int=200) -> None:
+    '''Slider lookups through per-square dicts against flat magic tables.'''
+
+    bishop_table, bishop_offsets, bishop_shifts = magic_table(
+        BISHOP_MASKS, BISHOP_MAGICS, bishop_attack_mask
+    )
+    rook_table, rook_offsets, rook_shifts = magic_table(
+        ROOK_MASKS, ROOK_MAGICS, rook_attack_mask
+    )
+
+    # Every square with the occupancy of each bench position
+    lookups = [(square, parse_fen(fen).occupied)
+               for fen in BENCH_FENS for square in range(64)]
+
+    for square, occupied in lookups:
+        assert bishop_table[
+            bishop_offsets[square]
+            + (uint64((occupied & BISHOP_MASKS[square])
+                      * BISHOP_MAGICS[square]) >> bishop_shifts[square])
+        ] == bishop_attacks(square, occupied)
+        assert rook_table[
+            rook_offsets[square]
+            + (uint64((occupied & ROOK_MASKS[square])
+                      * ROOK_MAGICS[square]) >> rook_shifts[square])
+        ] == rook_attacks(square, occupied)
+
+    start = time()
+    for _ in range(repeat):
+        for square, occupied in lookups:
+            BISHOP_ATTACKS[square][occupied & BISHOP_MASKS[square]]
+            ROOK_ATTACKS[square][occupied & ROOK_MASKS[square]]
+    report('dict', 2 * repeat * len(lookups), time() - start)
+
+    start = time()
+    for _ in range(repeat):
+        for square, occupied in lookups:
+            bishop_table[bishop_offsets[square]
+                         + (((occupied & BISHOP_MASKS[square])
+                             * BISHOP_MAGICS[square] & 0xFFFFFFFFFFFFFFFF)
+                            >> bishop_shifts[square])]
+            rook_table[rook_offsets[square]
+                       + (((occupied & ROOK_MASKS[square])
+                           * ROOK_MAGICS[square] & 0xFFFFFFFFFFFFFFFF)
+                          >> rook_shifts[square])]
+    report('magic', 2 * repeat * len(lookups), time() - start)
+
+BENCHMARKS = {
+    'make': bench_make_unmake,
+    'pseudo': bench_pseudo_legal,
+    'see': bench_see,
+    'nnue': bench_nnue,
+    'refresh': bench_refresh,
+    'squares': bench_squares,
+    'sliders': bench_sliders,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(f'# {name}')
+        BENCHMARKS[name]()
@@ -2,21 +2,11 @@ import itertools
 import sys
 
 from defs import *
+from tablecache import cached_tables
 
 def uint64(x: int) -> int:
     return x & 0xFFFFFFFFFFFFFFFF
 
-PAWN_ATTACKS = zeros(2, 64)
-KNIGHT_ATTACKS = zeros(64)
-KING_ATTACKS = zeros(64)
-
-BISHOP_MASKS = zeros(64)
-ROOK_MASKS = zeros(64)
-BISHOP_ATTACKS = [dict() for _ in range(64)]
-ROOK_ATTACKS = [dict() for _ in range(64)]
-
-BETWEEN = zeros(64, 64)
-
 def file_of(square: Square) -> int:
     return square & 7
 
@@ -60,11 +50,49 @@ def msb(bb: Bitboard) -> int:
     return bb.bit_length() - 1
 
 def lsb(bb: Bitboard) -> int:
-    if bb:
-        return bits((bb & -bb) - 1)
-    else:
-        return -1
-
+    return (bb & -bb).bit_length() - 1
+
+def square_table(offset: int) -> tuple[tuple[Square, ...], ...]:
+    '''Set squares, highest first, of every 8-bit chunk at an offset.'''
+    table = [()]
+    for square in range(offset, offset + 8):
+        table += [(square,) + chunk for chunk in table]
+    return tuple(table)
+
+# Square tuples for each 8-bit chunk of a bitboard. 16-bit chunks halve
+# the lookups but cost about 26 MiB in every process.
+SQUARES_0 = square_table(0)
+SQUARES_8 = square_table(8)
+SQUARES_16 = square_table(16)
+SQUARES_24 = square_table(24)
+SQUARES_32 = square_table(32)
+SQUARES_40 = square_table(40)
+SQUARES_48 = square_table(48)
+SQUARES_56 = square_table(56)
+
+def squares(bb: Bitboard) -> tuple[Square, ...]:
+    '''
+    Set squares of a bitboard, highest first like a msb loop. Most boards
+    from move generation have at most two squares, which are returned
+    directly. Denser boards look up eight 8-bit chunks, which is cheaper
+    than popping squares one at a time.
+    '''
+    if not bb:
+        return ()
+    rest = bb & (bb - 1)
+    if not rest:
+        return (bb.bit_length() - 1,)
+    if not rest & (rest - 1):
+        return rest.bit_length() - 1, (bb ^ rest).bit_length() - 1
+
+    return (SQUARES_56[bb >> 56] + SQUARES_48[bb >> 48 & 0xFF]
+            + SQUARES_40[bb >> 40 & 0xFF] + SQUARES_32[bb >> 32 & 0xFF]
+            + SQUARES_24[bb >> 24 & 0xFF] + SQUARES_16[bb >> 16 & 0xFF]
+            + SQUARES_8[bb >> 8 & 0xFF] + SQUARES_0[bb & 0xFF])
+
+# Slider lookups go through per-square dicts. Flat magic tables (see
+# magic.py) need a big int multiply per lookup and measure slower
+# in CPython, compare with: python bench.py sliders
 def bishop_attacks(square: Square, occupied: Bitboard) -> Bitboard:
     return BISHOP_ATTACKS[square][occupied & BISHOP_MASKS[square]]
 
@@ -167,74 +195,109 @@ def occupied_combinations(bitboard: Bitboard) -> iter:
                 occupied_mask |= 1 << square
             yield occupied_mask
 
-# Initialize between squares
-for start in range(64):
-    for end in range(start + 1, 64):
-        
-        if rank_of(start) == rank_of(end):
-            square = end + WEST
-            while square > start:
-                BETWEEN[start][end] |= uint64(1 << square)
-                square += WEST
-                
-        elif file_of(start) == file_of(end):
-            square = end + NORTH
-            while square > start:
-                BETWEEN[start][end] |= uint64(1 << square)
-                square += NORTH
-                
-        elif (end - start) % 9 == 0 and file_of(end) > file_of(start):
-            square = end + NORTH + WEST
-            while square > start:
-                BETWEEN[start][end] |= uint64(1 << square)
-                square += NORTH + WEST
-                
-        elif (end - start) % 7 == 0 and file_of(end) < file_of(start):
-            square = end + NORTH + EAST
-            while square > start:
-                BETWEEN[start][end] |= uint64(1 << square)
-                square += NORTH + EAST
-
-for start in range(64):
-    for end in range(start):
-        BETWEEN[start][end] = BETWEEN[end][start]
-
-for square in range(64):
-
-    # Pawn attack masks
-    PAWN_ATTACKS[WHITE][square] |= uint64((1 << square) >> 7) & uint64(~A_FILE)
-    PAWN_ATTACKS[WHITE][square] |= uint64((1 << square) >> 9) & uint64(~H_FILE)
-    PAWN_ATTACKS[BLACK][square] |= uint64((1 << square) << 7) & uint64(~H_FILE)
-    PAWN_ATTACKS[BLACK][square] |= uint64((1 << square) << 9) & uint64(~A_FILE)
-
-    # Knight attack masks
-    KNIGHT_ATTACKS[square] = (0
-        | (uint64((1 << square) >> 6) & uint64(~(A_FILE | B_FILE)))
-        | (uint64((1 << square) << 6) & uint64(~(G_FILE | H_FILE)))
-        | (uint64((1 << square) >> 10) & uint64(~(G_FILE | H_FILE)))
-        | (uint64((1 << square) << 10) & uint64(~(A_FILE | B_FILE)))
-        | (uint64((1 << square) >> 15) & uint64(~A_FILE))
-        | (uint64((1 << square) << 15) & uint64(~H_FILE))
-        | (uint64((1 << square) >> 17) & uint64(~H_FILE))
-        | (uint64((1 << square) << 17) & uint64(~A_FILE)))
-
-    # King attack masks
-    KING_ATTACKS[square] = (0
-        | (uint64((1 << square) >> 8))
-        | (uint64((1 << square) << 8))
-        | (uint64((1 << square) >> 1) & uint64(~H_FILE))
-        | (uint64((1 << square) << 1) & uint64(~A_FILE))
-        | (uint64((1 << square) >> 7) & uint64(~A_FILE))
-        | (uint64((1 << square) << 7) & uint64(~H_FILE))
-        | (uint64((1 << square) >> 9) & uint64(~H_FILE))
-        | (uint64((1 << square) << 9) & uint64(~A_FILE)))
-
-    # Bishop attack masks
-    BISHOP_MASKS[square] = relevant_bishop_bits(square)
-    for occupied in occupied_combinations(BISHOP_MASKS[square]):
-        BISHOP_ATTACKS[square][occupied] = bishop_attack_mask(square, occupied)
-
-    # Rook attack masks
-    ROOK_MASKS[square] = relevant_rook_bits(square)
-    for occupied in occupied_combinations(ROOK_MASKS[square]):
-        ROOK_ATTACKS[square][occupied] = rook_attack_mask(square, occupied)
+def build_tables() -> tuple:
+    '''Computes the attack, mask and line tables.'''
+
+    PAWN_ATTACKS = zeros(2, 64)
+    KNIGHT_ATTACKS = zeros(64)
+    KING_ATTACKS = zeros(64)
+
+    BISHOP_MASKS = zeros(64)
+    ROOK_MASKS = zeros(64)
+    BISHOP_ATTACKS = [dict() for _ in range(64)]
+    ROOK_ATTACKS = [dict() for _ in range(64)]
+
+    BETWEEN = zeros(64, 64)
+    LINES = zeros(64, 64)
+
+    # Initialize between squares
+    for start in range(64):
+        for end in range(start + 1, 64):
+
+            if rank_of(start) == rank_of(end):
+                square = end + WEST
+                while square > start:
+                    BETWEEN[start][end] |= uint64(1 << square)
+                    square += WEST
+
+            elif file_of(start) == file_of(end):
+                square = end + NORTH
+                while square > start:
+                    BETWEEN[start][end] |= uint64(1 << square)
+                    square += NORTH
+
+            elif (end - start) % 9 == 0 and file_of(end) > file_of(start):
+                square = end + NORTH + WEST
+                while square > start:
+                    BETWEEN[start][end] |= uint64(1 << square)
+                    square += NORTH + WEST
+
+            elif (end - start) % 7 == 0 and file_of(end) < file_of(start):
+                square = end + NORTH + EAST
+                while square > start:
+                    BETWEEN[start][end] |= uint64(1 << square)
+                    square += NORTH + EAST
+
+    for start in range(64):
+        for end in range(start):
+            BETWEEN[start][end] = BETWEEN[end][start]
+
+    # Initialize lines through two aligned squares (edge to edge)
+    for start in range(64):
+        for end in range(64):
+            if start == end:
+                continue
+            for attack_mask in (bishop_attack_mask, rook_attack_mask):
+                if attack_mask(start, 0) & (1 << end):
+                    LINES[start][end] = (attack_mask(start, 0)
+                                         & attack_mask(end, 0)
+                                         | (1 << start) | (1 << end))
+
+    for square in range(64):
+
+        # Pawn attack masks
+        PAWN_ATTACKS[WHITE][square] |= uint64((1 << square) >> 7) & uint64(~A_FILE)
+        PAWN_ATTACKS[WHITE][square] |= uint64((1 << square) >> 9) & uint64(~H_FILE)
+        PAWN_ATTACKS[BLACK][square] |= uint64((1 << square) << 7) & uint64(~H_FILE)
+        PAWN_ATTACKS[BLACK][square] |= uint64((1 << square) << 9) & uint64(~A_FILE)
+
+        # Knight attack masks
+        KNIGHT_ATTACKS[square] = (0
+            | (uint64((1 << square) >> 6) & uint64(~(A_FILE | B_FILE)))
+            | (uint64((1 << square) << 6) & uint64(~(G_FILE | H_FILE)))
+            | (uint64((1 << square) >> 10) & uint64(~(G_FILE | H_FILE)))
+            | (uint64((1 << square) << 10) & uint64(~(A_FILE | B_FILE)))
+            | (uint64((1 << square) >> 15) & uint64(~A_FILE))
+            | (uint64((1 << square) << 15) & uint64(~H_FILE))
+            | (uint64((1 << square) >> 17) & uint64(~H_FILE))
+            | (uint64((1 << square) << 17) & uint64(~A_FILE)))
+
+        # King attack masks
+        KING_ATTACKS[square] = (0
+            | (uint64((1 << square) >> 8))
+            | (uint64((1 << square) << 8))
+            | (uint64((1 << square) >> 1) & uint64(~H_FILE))
+            | (uint64((1 << square) << 1) & uint64(~A_FILE))
+            | (uint64((1 << square) >> 7) & uint64(~A_FILE))
+            | (uint64((1 << square) << 7) & uint64(~H_FILE))
+            | (uint64((1 << square) >> 9) & uint64(~H_FILE))
+            | (uint64((1 << square) << 9) & uint64(~A_FILE)))
+
+        # Bishop attack masks
+        BISHOP_MASKS[square] = relevant_bishop_bits(square)
+        for occupied in occupied_combinations(BISHOP_MASKS[square]):
+            BISHOP_ATTACKS[square][occupied] = bishop_attack_mask(square, occupied)
+
+        # Rook attack masks
+        ROOK_MASKS[square] = relevant_rook_bits(square)
+        for occupied in occupied_combinations(ROOK_MASKS[square]):
+            ROOK_ATTACKS[square][occupied] = rook_attack_mask(square, occupied)
+
+    return (PAWN_ATTACKS, KNIGHT_ATTACKS, KING_ATTACKS,
+            BISHOP_MASKS, ROOK_MASKS, BISHOP_ATTACKS, ROOK_ATTACKS,
+            BETWEEN, LINES)
+
+# Building the tables takes most of a second, so they are cached on disk
+(PAWN_ATTACKS, KNIGHT_ATTACKS, KING_ATTACKS,
+ BISHOP_MASKS, ROOK_MASKS, BISHOP_ATTACKS, ROOK_ATTACKS,
+ BETWEEN, LINES) = cached_tables('bitboard', build_tables, ('defs',))
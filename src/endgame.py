@@ -37,9 +37,7 @@ def mop_up_evaluation(pos: Position) -> Value:
     v += bits(queens) * PIECE_VALUES[QUEEN]
 
     # Greater bonus for pawns further down the board
-    while pawns:
-        sq = msb(pawns)
-        pawns ^= 1 << sq
+    for sq in squares(pawns):
         v += 6 * rank_of(sq ^ (56, 0)[ss])**2
 
     if not bishops:
@@ -47,7 +45,7 @@ def mop_up_evaluation(pos: Position) -> Value:
     else:
         corners = (A1, H8) if bishops & DARK_SQUARES else (A8, H1)
     
-    king_distance = DISTANCE[msb(bitboards[KING + ss])][msb(bitboards[ws])]
+    king_distance = DISTANCE[pos.king_squares[ss]][pos.king_squares[ws]]
     corner_distance = min(DISTANCE[KING + ws][corner] for corner in corners)
 
     # Push king to corner
@@ -14,16 +14,15 @@ def evaluate(pos: Position) -> Value:
     except NoMopUpEvaluation:
         pass
     
+    refresh_accumulator(pos)
+
+    accumulator = accumulator_values(pos.accumulator)
+
     us = pos.side
-    ours = pos.accumulator[us]        # Our accumulation
-    theirs = pos.accumulator[not us]  # Their accumulation
+    ours = accumulator[us]        # Our accumulation
+    theirs = accumulator[not us]  # Their accumulation
 
     # Hidden layer forward propogation
-    v = OUTPUT_BIAS * QUANTIZATION_PRECISION_IN + sum([
-        + (our_activation * our_weight if our_activation > 0 else 0)
-        + (their_activation * their_weight if their_activation > 0 else 0)
-        for our_activation, their_activation, our_weight, their_weight
-        in zip(ours, theirs, OUR_HIDDEN_WEIGHTS, THEIR_HIDDEN_WEIGHTS)
-    ])
+    v = OUTPUT_BIAS * QUANTIZATION_PRECISION_IN + hidden_output(ours, theirs)
     
     return Value(v / QUANTIZATION_PRECISION_IN / QUANTIZATION_PRECISION_OUT)
@@ -0,0 +1,137 @@
+'''
+Fancy magic multipliers and flat slider attack tables. The engine looks
+up slider attacks in per-square dicts, these are kept for comparison,
+see: python bench.py sliders
+'''
+
+from random import Random
+from typing import Callable
+
+from bitboard import *
+
+# Fancy magic multipliers for flat slider attack tables, found with
+#   rng = Random(1)
+#   ROOK_MAGICS = find_magics(ROOK_MASKS, rook_attack_mask, rng)
+#   BISHOP_MAGICS = find_magics(BISHOP_MASKS, bishop_attack_mask, rng)
+BISHOP_MAGICS = (
+    0x0010104088840042, 0x0110104081004062, 0x0091142082000100,
+    0x0108208821008100, 0x0101104000080000, 0x010104200404001C,
+    0x0C01040202C00010, 0x0001004800841080, 0xCA8B46100E280102,
+    0x001010D00085024C, 0x4180089881020120, 0x8010082050411000,
+    0x0800020210100000, 0x0002120905201200, 0xC000040404040510,
+    0x0110410101100200, 0x0042201408020C27, 0xA882000404440C20,
+    0x0002000102040100, 0x800200202202C200, 0x4002005012101401,
+    0x2441014880600200, 0x0214020104018400, 0x000180004414410A,
+    0x0105410C10020800, 0x0004200084013400, 0x200582045004001B,
+    0x1000404004010200, 0x0001001081004021, 0x2400430202008628,
+    0x000604C144230800, 0x04004840008A1804, 0x4010045000220210,
+    0x2012100400500120, 0x10001C0205900081, 0x0020880800360A00,
+    0x8500460020060080, 0x0420008209010110, 0x0010020250008C00,
+    0x8010A40100004104, 0x00008208400022C8, 0x0008410450402100,
+    0x0008920110004104, 0x43A8011044002024, 0x0029102021900602,
+    0x2270101000212040, 0x0020C41112004040, 0x3004840550C42200,
+    0x5002022202404480, 0x0402822309200840, 0x0032010423240048,
+    0x2000CA0384110008, 0x4001140410440000, 0x2092E50810011010,
+    0x0140040852005041, 0x00200200C1010104, 0x40120202020104E0,
+    0xA000010042300500, 0x400048004A009001, 0x4200800400411081,
+    0x0010040604105400, 0x0107004210024080, 0x0004423004210040,
+    0xC220023088010040,
+)
+
+ROOK_MAGICS = (
+    0x128012C0008000E0, 0x0240002000401001, 0x4100200041001008,
+    0x8280100008018004, 0x2080080002040080, 0x1300010004008208,
+    0x04000208A9101408, 0x020000204A018F04, 0x1080800040008020,
+    0x0000C01000402001, 0x0080808010002000, 0x0408800800801000,
+    0x0010800801040080, 0x4804800400804200, 0x0304800D00800200,
+    0x010200040081006A, 0x8280044020084000, 0x042000C010004021,
+    0x2010002004080020, 0x0040210010000900, 0x0008004004020041,
+    0x0004008080040200, 0x1C20040070610208, 0x1020A20000508104,
+    0x0100C00380008120, 0x4001200280400080, 0x0200100080200080,
+    0x0000401200082200, 0xC02C080080040080, 0x0840040080020080,
+    0x2102004040800100, 0x0042079A00004104, 0x0000400424800280,
+    0x4820100020400040, 0x5010002000801880, 0x9061080081801002,
+    0x208A050011000800, 0x000200080E003094, 0xA010018204003008,
+    0x2000288042001401, 0x400181C000228000, 0x0200402010004000,
+    0x8388928600420021, 0x400021001001000A, 0x2100080011010004,
+    0x1002020004008080, 0x0802000804020001, 0x88004410408A0001,
+    0x010508C030800100, 0x4000400080310100, 0x0030200010048080,
+    0x2000800800100080, 0x0100040008008080, 0x0022000204008080,
+    0x0108020170284400, 0x1001010084004200, 0x0004890141902202,
+    0x0100881100220042, 0x0100102001000841, 0x4408050020081001,
+    0x0002008884201002, 0x2002000490410802, 0x0020014800900204,
+    0x0100082081044402,
+)
+
+def find_magics(masks: list[Bitboard], attack_mask: Callable,
+                rng: Random) -> tuple[int, ...]:
+    '''
+    Searches for a fancy magic multiplier for every square. A magic maps
+    each occupancy of the mask to an index without destructive
+    collisions. This takes a while for rooks, so the results are kept in
+    BISHOP_MAGICS and ROOK_MAGICS.
+    '''
+
+    magics = []
+
+    for square in range(64):
+        mask = masks[square]
+        shift = 64 - bits(mask)
+        occupancies = list(occupied_combinations(mask))
+        attacks = [attack_mask(square, occupied) for occupied in occupancies]
+
+        while True:
+            magic = rng.getrandbits(64) & rng.getrandbits(64) & rng.getrandbits(64)
+            # Magics that spread the mask poorly can be skipped early
+            if bits(uint64(mask * magic) >> 56) < 6:
+                continue
+            table = [None] * (1 << (64 - shift))
+            for occupied, attack in zip(occupancies, attacks):
+                index = uint64(occupied * magic) >> shift
+                if table[index] is None:
+                    table[index] = attack
+                elif table[index] != attack:
+                    break
+            else:
+                magics.append(magic)
+                break
+
+    return tuple(magics)
+
+def magic_table(masks: list[Bitboard], magics: tuple[int, ...],
+                attack_mask: Callable) -> tuple[list[Bitboard], list[int],
+                                                list[int]]:
+    '''
+    Builds a flat slider attack table with an offset and shift for every
+    square. The attacks of a square are then found at
+    table[offsets[square] + (uint64((occupied & mask) * magic) >> shift)].
+    Every occupancy is checked against attack_mask while filling the
+    table, so a bad magic raises a ValueError.
+    '''
+
+    table = []
+    offsets = []
+    shifts = []
+
+    for square in range(64):
+        mask = masks[square]
+        magic = magics[square]
+        shift = 64 - bits(mask)
+        offset = len(table)
+        table += [None] * (1 << (64 - shift))
+
+        for occupied in occupied_combinations(mask):
+            attacks = attack_mask(square, occupied)
+            index = offset + (uint64(occupied * magic) >> shift)
+            if table[index] is None:
+                table[index] = attacks
+            elif table[index] != attacks:
+                raise ValueError(f'bad magic for square {square}')
+
+        offsets.append(offset)
+        shifts.append(shift)
+
+    # Indices no occupancy maps to are never read
+    table = [0 if attacks is None else attacks for attacks in table]
+
+    return table, offsets, shifts
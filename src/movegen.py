@@ -3,15 +3,42 @@ from __future__ import annotations
 from bitboard import *
 from defs import *
 from move import *
+from tablecache import cached_tables
+
+def build_move_tables() -> tuple:
+    '''Encoded quiet and capture moves by piece, start and end square.'''
+
+    quiet_moves = [[tuple(make_move(start, end, piece) for end in range(64))
+                    for start in range(64)] for piece in PIECES]
+    capture_moves = [[tuple(make_move(start, end, piece, True)
+                            for end in range(64))
+                      for start in range(64)] for piece in PIECES]
+
+    return quiet_moves, capture_moves
+
+QUIET_MOVES, CAPTURE_MOVES = cached_tables('movegen', build_move_tables,
+                                           ('move', 'bitboard', 'defs'))
+
+# Pin masks for pseudo-legal generation
+NO_PINS = (-1,) * 64
 
 SLIDERS = (
     (WHITE_BISHOP, WHITE_ROOK, WHITE_QUEEN),
     (BLACK_BISHOP, BLACK_ROOK, BLACK_QUEEN),
 )
-SLIDER_ATTACKS = bishop_attacks, rook_attacks, queen_attacks
 
-def gen_tacticals(pos: Position) -> iter:
-    '''Generates tactical moves (promotions & captures).'''
+def gen_tacticals(pos: Position, moves: list[Move]=None,
+                  legal: bool=True) -> list[Move]:
+    '''
+    Generates tactical moves (promotions & captures). Moves are added to
+    the given list, or a new one, which is returned.
+    With legal=False moves are pseudo-legal: pins and king safety are
+    left to is_pseudo_legal_move_legal. Castling is always legal.
+    '''
+
+    if moves is None:
+        moves = []
+    append = moves.append
 
     board = pos.board
     bitboards = pos.bitboards
@@ -19,7 +46,6 @@ def gen_tacticals(pos: Position) -> iter:
     xside = not side
     ep_square = pos.ep_square
     occupied = pos.occupied
-    attacked = pos.attacked
     checkers = pos.checkers
         
     # Only king moves if more than one checker
@@ -27,40 +53,37 @@ def gen_tacticals(pos: Position) -> iter:
         
         # Get king square
         king = KING + side
-        start = msb(bitboards[king])
+        start = pos.king_squares[side]
         # King attacks bitboard
-        attacks = KING_ATTACKS[start] & bitboards[xside] & ~attacked
+        attacks = KING_ATTACKS[start] & bitboards[xside] & ~pos.attacked
         # Loop through king attacks
-        while attacks:
-            end = msb(attacks)
-            attacks ^= 1 << end
-            yield make_move(start, end, king, True)
+        encoded = CAPTURE_MOVES[king][start]
+        for end in squares(attacks):
+            append(encoded[end])
         
-        return
+        return moves
 
     check_mask = pos.check_mask
-    pin_masks = pos.pin_masks
+    pin_masks = pos.pin_masks if legal else NO_PINS
 
     # White pawn tacticals
     if side == WHITE:
 
         # Get white pawn bitboard
         bitboard = bitboards[WHITE_PAWN]
+        pawn_push = (bitboard >> 8) & ~occupied
         # Loop through pawn bitboard
-        while bitboard:
-            start = msb(bitboard)
+        for start in squares(bitboard):
             end = start - 8
-            pawn_push = (bitboard >> 8) & ~occupied
-            bitboard ^= 1 << start
 
             # Single pawn push promotion
             if ((1 << end) & RANK_8 & pawn_push
                 & pin_masks[start] & check_mask):
                 #assert start != F7 and end != E8, print(pos)
-                yield make_move(start, end, WHITE_PAWN, flag=WHITE_QUEEN)
-                yield make_move(start, end, WHITE_PAWN, flag=WHITE_KNIGHT)
-                yield make_move(start, end, WHITE_PAWN, flag=WHITE_ROOK)
-                yield make_move(start, end, WHITE_PAWN, flag=WHITE_BISHOP)
+                append(make_move(start, end, WHITE_PAWN, flag=WHITE_QUEEN))
+                append(make_move(start, end, WHITE_PAWN, flag=WHITE_KNIGHT))
+                append(make_move(start, end, WHITE_PAWN, flag=WHITE_ROOK))
+                append(make_move(start, end, WHITE_PAWN, flag=WHITE_BISHOP))
 
             # Get pawn attacks bitboard
             attacks = (
@@ -68,18 +91,16 @@ def gen_tacticals(pos: Position) -> iter:
                 & pin_masks[start] & check_mask
             )
             # Loop through attacks bitboard
-            while attacks:
-                end = msb(attacks)
-                attacks ^= 1 << end
+            for end in squares(attacks):
                 # Promoting captures
                 if (1 << end) & RANK_8:
-                    yield make_move(start, end, WHITE_PAWN, True, WHITE_QUEEN)
-                    yield make_move(start, end, WHITE_PAWN, True, WHITE_KNIGHT)
-                    yield make_move(start, end, WHITE_PAWN, True, WHITE_ROOK)
-                    yield make_move(start, end, WHITE_PAWN, True, WHITE_BISHOP)
+                    append(make_move(start, end, WHITE_PAWN, True, WHITE_QUEEN))
+                    append(make_move(start, end, WHITE_PAWN, True, WHITE_KNIGHT))
+                    append(make_move(start, end, WHITE_PAWN, True, WHITE_ROOK))
+                    append(make_move(start, end, WHITE_PAWN, True, WHITE_BISHOP))
                 # Non-promoting captures
                 else:
-                    yield make_move(start, end, WHITE_PAWN, True)
+                    append(CAPTURE_MOVES[WHITE_PAWN][start][end])
                     
             # En passant
             ep_bb = 1 << ep_square
@@ -88,41 +109,37 @@ def gen_tacticals(pos: Position) -> iter:
                 and bitboards[BLACK_PAWN] & check_mask
                 and PAWN_ATTACKS[WHITE][start] & pin_masks[start] & ep_bb):
                 # Get king square and potential horizontal pinners
-                king_sq = msb(bitboards[WHITE_KING])
+                king_sq = pos.king_squares[WHITE]
                 horizontal_sliders = (
                     (bitboards[BLACK_ROOK] | bitboards[BLACK_QUEEN])
                     & RANK_MASKS[rank_of(king_sq)] & RANK_5
                 )
                 # Check if there is a horizontal pin
-                while horizontal_sliders:
-                    slider_sq = msb(horizontal_sliders)
+                for slider_sq in squares(horizontal_sliders):
                     if bits(BETWEEN[king_sq][slider_sq] & occupied) == 2:
                         break
-                    horizontal_sliders ^= 1 << slider_sq
                 # There is no en passant pin
                 else:
                     end = msb(PAWN_ATTACKS[WHITE][start] & ep_bb)
-                    yield make_move(start, end, WHITE_PAWN, True, ENPASSANT)
+                    append(make_move(start, end, WHITE_PAWN, True, ENPASSANT))
 
     # Black pawn tacticals
     else:
 
         # Get black pawn bitboard
         bitboard = bitboards[BLACK_PAWN]
+        pawn_push = (bitboard << 8) & ~occupied
         # Loop through pawn bitboard
-        while bitboard:
-            start = msb(bitboard)
+        for start in squares(bitboard):
             end = start + 8
-            pawn_push = (bitboard << 8) & ~occupied
-            bitboard ^= 1 << start 
 
             # Single pawn push promotion
             if ((1 << end) & RANK_1 & pawn_push
                 & pin_masks[start] & check_mask):
-                yield make_move(start, end, BLACK_PAWN, flag=BLACK_QUEEN)
-                yield make_move(start, end, BLACK_PAWN, flag=BLACK_KNIGHT)
-                yield make_move(start, end, BLACK_PAWN, flag=BLACK_ROOK)
-                yield make_move(start, end, BLACK_PAWN, flag=BLACK_BISHOP)
+                append(make_move(start, end, BLACK_PAWN, flag=BLACK_QUEEN))
+                append(make_move(start, end, BLACK_PAWN, flag=BLACK_KNIGHT))
+                append(make_move(start, end, BLACK_PAWN, flag=BLACK_ROOK))
+                append(make_move(start, end, BLACK_PAWN, flag=BLACK_BISHOP))
 
             # Get pawn attacks bitboard
             attacks = (
@@ -130,18 +147,16 @@ def gen_tacticals(pos: Position) -> iter:
                 & pin_masks[start] & check_mask
             )
             # Loop through attacks bitboard
-            while attacks:
-                end = msb(attacks)
-                attacks ^= 1 << end
+            for end in squares(attacks):
                 # Promoting captures
                 if (1 << end) & RANK_1:
-                    yield make_move(start, end, BLACK_PAWN, True, BLACK_QUEEN)
-                    yield make_move(start, end, BLACK_PAWN, True, BLACK_KNIGHT)
-                    yield make_move(start, end, BLACK_PAWN, True, BLACK_ROOK)
-                    yield make_move(start, end, BLACK_PAWN, True, BLACK_BISHOP)
+                    append(make_move(start, end, BLACK_PAWN, True, BLACK_QUEEN))
+                    append(make_move(start, end, BLACK_PAWN, True, BLACK_KNIGHT))
+                    append(make_move(start, end, BLACK_PAWN, True, BLACK_ROOK))
+                    append(make_move(start, end, BLACK_PAWN, True, BLACK_BISHOP))
                 # Non-promoting capture
                 else:
-                    yield make_move(start, end, BLACK_PAWN, True)
+                    append(CAPTURE_MOVES[BLACK_PAWN][start][end])
                     
             # En passant
             ep_bb = 1 << ep_square
@@ -150,71 +165,81 @@ def gen_tacticals(pos: Position) -> iter:
                 and bitboards[WHITE_PAWN] & check_mask
                 and PAWN_ATTACKS[BLACK][start] & pin_masks[start] & ep_bb):
                 # Get king square and potential pinners
-                king_sq = msb(bitboards[BLACK_KING])
+                king_sq = pos.king_squares[BLACK]
                 horizontal_sliders = (
                     (bitboards[WHITE_ROOK] | bitboards[WHITE_QUEEN])
                     & RANK_MASKS[rank_of(king_sq)] & RANK_4
                 )
                 # Check if there is a horizontal pin
-                while horizontal_sliders:
-                    slider_sq = msb(horizontal_sliders)
+                for slider_sq in squares(horizontal_sliders):
                     if bits(BETWEEN[king_sq][slider_sq] & occupied) == 2:
                         break
-                    horizontal_sliders ^= 1 << slider_sq
                 # There is no en passant pin
                 else:
                     end = msb(PAWN_ATTACKS[BLACK][start] & ep_bb)
-                    yield make_move(start, end, BLACK_PAWN, True, ENPASSANT)           
+                    append(make_move(start, end, BLACK_PAWN, True, ENPASSANT))
 
     # Get knight bitboard
     knight = KNIGHT + side
     bitboard = bitboards[knight]
     # Loop through knight bitboard
-    while bitboard:
-        start = msb(bitboard)
-        bitboard ^= 1 << start
+    for start in squares(bitboard):
         # Knight attacks bitboard
         attacks = (
             KNIGHT_ATTACKS[start] & bitboards[xside]
             & pin_masks[start] & check_mask
         )
         # Loop through knight attacks
-        while attacks:
-            end = msb(attacks)
-            attacks ^= 1 << end
-            yield make_move(start, end, knight, True)
+        encoded = CAPTURE_MOVES[knight][start]
+        for end in squares(attacks):
+            append(encoded[end])
     
+    # Slider attacks come from the shared attack map
+    pos.attacks_by(side)
+    piece_attacks = pos.attack_map.piece_attacks
+
     # Loop through slider types
-    for piece, piece_attacks in zip(SLIDERS[side], SLIDER_ATTACKS):
+    for piece in SLIDERS[side]:
         bitboard = bitboards[piece]
         # Loop through slider bitboard
-        while bitboard:
-            start = msb(bitboard)
-            bitboard ^= 1 << start
+        for start in squares(bitboard):
             # Slider attacks bitboard
             attacks = (
-                piece_attacks(start, occupied) & bitboards[xside]
+                piece_attacks[start] & bitboards[xside]
                 & pin_masks[start] & check_mask
             )
             # Loop through slider attacks
-            while attacks:
-                end = msb(attacks)
-                attacks ^= 1 << end
-                yield make_move(start, end, piece, True)
+            encoded = CAPTURE_MOVES[piece][start]
+            for end in squares(attacks):
+                append(encoded[end])
                 
     # Get king square
     king = KING + side
-    start = msb(bitboards[king])
-    # King attacks bitboard
-    attacks = KING_ATTACKS[start] & bitboards[xside] & ~attacked
+    start = pos.king_squares[side]
+    # King attacks bitboard. The enemy attack map is only built if the
+    # king has something to capture.
+    attacks = KING_ATTACKS[start] & bitboards[xside]
+    if attacks and legal:
+        attacks &= ~pos.attacked
     # Loop through king attacks
-    while attacks:
-        end = msb(attacks)
-        attacks ^= 1 << end
-        yield make_move(start, end, king, True)
-                
-def gen_quiets(pos: Position) -> iter:
-    '''Generate quiet moves.'''
+    encoded = CAPTURE_MOVES[king][start]
+    for end in squares(attacks):
+        append(encoded[end])
+
+    return moves
+
+def gen_quiets(pos: Position, moves: list[Move]=None,
+               legal: bool=True) -> list[Move]:
+    '''
+    Generate quiet moves. Moves are added to the given list, or a new
+    one, which is returned.
+    With legal=False moves are pseudo-legal: pins and king safety are
+    left to is_pseudo_legal_move_legal. Castling is always legal.
+    '''
+
+    if moves is None:
+        moves = []
+    append = moves.append
 
     board = pos.board
     bitboards = pos.bitboards
@@ -222,7 +247,6 @@ def gen_quiets(pos: Position) -> iter:
     xside = not side
     castling = pos.castling
     occupied = pos.occupied
-    attacked = pos.attacked
     checkers = pos.checkers
         
     # Only king moves if more than one checker
@@ -230,188 +254,477 @@ def gen_quiets(pos: Position) -> iter:
         
         # Get king square
         king = KING + side
-        start = msb(bitboards[king])
+        start = pos.king_squares[side]
         # King attacks bitboard
-        attacks = KING_ATTACKS[start] & ~occupied & ~attacked
+        attacks = KING_ATTACKS[start] & ~occupied & ~pos.attacked
         # Loop through king attacks
-        while attacks:
-            end = msb(attacks)
-            attacks ^= 1 << end
-            yield make_move(start, end, king)
+        encoded = QUIET_MOVES[king][start]
+        for end in squares(attacks):
+            append(encoded[end])
         
-        return
+        return moves
 
     check_mask = pos.check_mask
-    pin_masks = pos.pin_masks
+    pin_masks = pos.pin_masks if legal else NO_PINS
 
     # White pawn and castle moves
     if side == WHITE:
 
         # White kingside castle
         if (castling & 0x1
-            and not 0x7000000000000000 & attacked
-            and not ((1 << F1) | (1 << G1)) & occupied):
-            yield make_move(E1, G1, WHITE_KING, flag=CASTLE)
+            and not ((1 << F1) | (1 << G1)) & occupied
+            and not 0x7000000000000000 & pos.attacked):
+            append(make_move(E1, G1, WHITE_KING, flag=CASTLE))
         # White queenside castle
         if (castling & 0x2
-            and not 0x1c00000000000000 & attacked
-            and not ((1 << B1) | (1 << C1) | (1 << D1)) & occupied):
-            yield make_move(E1, C1, WHITE_KING, flag=CASTLE)
+            and not ((1 << B1) | (1 << C1) | (1 << D1)) & occupied
+            and not 0x1c00000000000000 & pos.attacked):
+            append(make_move(E1, C1, WHITE_KING, flag=CASTLE))
 
         # Get white pawn bitboard
         bitboard = bitboards[WHITE_PAWN]
+        pawn_push = (bitboard >> 8) & ~occupied & ~RANK_8
+        double_pawn_push = (pawn_push >> 8) & ~occupied & RANK_4
         # Loop through white pawn bitboard
-        while bitboard:
-            start = msb(bitboard)
-            end = start - 8
+        for start in squares(bitboard):
             # Single pawn push
-            pawn_push = (bitboard >> 8) & ~occupied & ~RANK_8
-            bitboard ^= 1 << start
+            end = start - 8
             if (1 << end) & pawn_push & pin_masks[start] & check_mask:
-                yield make_move(start, end, WHITE_PAWN)
+                append(QUIET_MOVES[WHITE_PAWN][start][end])
             # Double pawn push
             end = max(start - 16, 0)
-            double_pawn_push = (pawn_push >> 8) & ~occupied & RANK_4
             if (1 << end) & double_pawn_push & pin_masks[start] & check_mask:
-                yield make_move(start, end, WHITE_PAWN, flag=DOUBLE)
+                append(make_move(start, end, WHITE_PAWN, flag=DOUBLE))
 
     # Black pawn and castle moves
     else:
 
         # Black kingside castle
         if (castling & 0x4
-            and not 0x70 & attacked
-            and not ((1 << F8) | (1 << G8)) & occupied):
-            yield make_move(E8, G8, BLACK_KING, flag = CASTLE)
+            and not ((1 << F8) | (1 << G8)) & occupied
+            and not 0x70 & pos.attacked):
+            append(make_move(E8, G8, BLACK_KING, flag=CASTLE))
         # Black queenside castle
         if (castling & 0x8
-            and not 0x1c & attacked
-            and not ((1 << B8) | (1 << C8) | (1 << D8)) & occupied):
-            yield make_move(E8, C8, BLACK_KING, flag=CASTLE)
+            and not ((1 << B8) | (1 << C8) | (1 << D8)) & occupied
+            and not 0x1c & pos.attacked):
+            append(make_move(E8, C8, BLACK_KING, flag=CASTLE))
         
         # Get black pawn bitboard
         bitboard = bitboards[BLACK_PAWN]
+        pawn_push = (bitboard << 8) & ~occupied & ~RANK_1
+        double_pawn_push = (pawn_push << 8) & ~occupied & RANK_5
         # Loop through black pawn bitboard
-        while bitboard:
-            start = msb(bitboard)
+        for start in squares(bitboard):
             # Single pawn push
             end = start + 8
-            pawn_push = (bitboard << 8) & ~occupied & ~RANK_1
-            bitboard ^= 1 << start
             if (1 << end) & pawn_push & pin_masks[start] & check_mask:
-                yield make_move(start, end, BLACK_PAWN)
+                append(QUIET_MOVES[BLACK_PAWN][start][end])
             # Double pawn push
             end = start + 16
-            double_pawn_push = (pawn_push << 8) & ~occupied & RANK_5
             if (1 << end) & double_pawn_push & pin_masks[start] & check_mask:
-                yield make_move(start, end, BLACK_PAWN, flag=DOUBLE)
+                append(make_move(start, end, BLACK_PAWN, flag=DOUBLE))
 
     # Get knight bitboard
     knight = KNIGHT + side
     bitboard = bitboards[knight]
     # Loop through knights
-    while bitboard:
-        start = msb(bitboard)
-        bitboard ^= 1 << start
+    for start in squares(bitboard):
         # Knight attacks bitboard
         attacks = (
             KNIGHT_ATTACKS[start] & ~occupied
             & pin_masks[start] & check_mask
         )
         # Loop through knight attacks
-        while attacks:
-            end = msb(attacks)
-            attacks ^= 1 << end
-            yield make_move(start, end, knight)
+        encoded = QUIET_MOVES[knight][start]
+        for end in squares(attacks):
+            append(encoded[end])
+
+    # Slider attacks come from the shared attack map
+    pos.attacks_by(side)
+    piece_attacks = pos.attack_map.piece_attacks
 
     # Loop through slider types
-    for piece, piece_attacks in zip(SLIDERS[side], SLIDER_ATTACKS):
+    for piece in SLIDERS[side]:
         bitboard = bitboards[piece]
         # Loop through sliders
-        while bitboard:
-            start = msb(bitboard)
-            bitboard ^= 1 << start
+        for start in squares(bitboard):
             # Slider attacks bitboard
             attacks = (
-                piece_attacks(start, occupied) & ~occupied
+                piece_attacks[start] & ~occupied
                 & pin_masks[start] & check_mask
             )
             # Loop through slider attacks
-            while attacks:
-                end = msb(attacks)
-                attacks ^= 1 << end
-                yield make_move(start, end, piece)
+            encoded = QUIET_MOVES[piece][start]
+            for end in squares(attacks):
+                append(encoded[end])
              
     # Get king square
     king = KING + side
-    start = msb(bitboards[king])
-    # King attacks bitboard
-    attacks = KING_ATTACKS[start] & ~occupied & ~attacked
+    start = pos.king_squares[side]
+    # King attacks bitboard. The enemy attack map is only built if the
+    # king has somewhere to go.
+    attacks = KING_ATTACKS[start] & ~occupied
+    if attacks and legal:
+        attacks &= ~pos.attacked
     # Loop through king attacks
-    while attacks:
-        end = msb(attacks)
-        attacks ^= 1 << end
-        yield make_move(start, end, king)
-                
-def gen_perft(pos: Position):
+    encoded = QUIET_MOVES[king][start]
+    for end in squares(attacks):
+        append(encoded[end])
+
+    return moves
+
+def is_ep_legal(pos: Position, start: Square) -> bool:
+    '''
+    Whether an en passant capture from start leaves the king safe, found
+    by checking the position after the capture directly.
+    '''
+
+    bitboards = pos.bitboards
+    side = pos.side
+    xside = not side
+    ep_square = pos.ep_square
+    king_sq = pos.king_squares[side]
+    captured_sq = ep_square + (SOUTH if side == WHITE else NORTH)
+
+    after = (pos.occupied ^ (1 << start) ^ (1 << captured_sq)
+             | (1 << ep_square))
+    enemies = bitboards[xside] & ~(1 << captured_sq)
+
+    return not (
+        rook_attacks(king_sq, after) & enemies
+        & (bitboards[ROOK + xside] | bitboards[QUEEN + xside])
+        or bishop_attacks(king_sq, after) & enemies
+        & (bitboards[BISHOP + xside] | bitboards[QUEEN + xside])
+        or KNIGHT_ATTACKS[king_sq] & bitboards[KNIGHT + xside]
+        or PAWN_ATTACKS[side][king_sq] & enemies & bitboards[PAWN + xside]
+    )
+
+PROMOTIONS = (
+    (WHITE_QUEEN, WHITE_KNIGHT, WHITE_ROOK, WHITE_BISHOP),
+    (BLACK_QUEEN, BLACK_KNIGHT, BLACK_ROOK, BLACK_BISHOP),
+)
+
+def gen_evasions(pos: Position, moves: list[Move]=None) -> list[Move]:
+    '''
+    Generates the moves out of check: king escapes, captures of the
+    checking piece and interpositions. Only valid when in check. Moves
+    are added to the given list, or a new one, which is returned.
+    '''
+
+    if moves is None:
+        moves = []
+    append = moves.append
+
+    board = pos.board
+    bitboards = pos.bitboards
+    side = pos.side
+    xside = not side
+    occupied = pos.occupied
+    checkers = pos.checkers
+
+    # King escapes
+    king = KING + side
+    king_sq = pos.king_squares[side]
+    attacks = KING_ATTACKS[king_sq] & ~bitboards[side] & ~pos.attacked
+    encoded = CAPTURE_MOVES[king][king_sq]
+    for end in squares(attacks & bitboards[xside]):
+        append(encoded[end])
+    encoded = QUIET_MOVES[king][king_sq]
+    for end in squares(attacks & ~occupied):
+        append(encoded[end])
+
+    # Only king moves if more than one checker
+    if checkers & (checkers - 1):
+        return moves
+
+    checker_sq = msb(checkers)
+    blocks = BETWEEN[checker_sq][king_sq]
+    pin_masks = pos.pin_masks
+    pawn = PAWN + side
+    promotions = PROMOTIONS[side]
+    last_rank = RANK_8 if side == WHITE else RANK_1
+    pawns = bitboards[pawn]
+
+    # Pawn captures of the checker
+    for start in squares(PAWN_ATTACKS[xside][checker_sq] & pawns):
+        if pin_masks[start] & checkers:
+            if checkers & last_rank:
+                for promotion in promotions:
+                    append(make_move(start, checker_sq, pawn, True, promotion))
+            else:
+                append(CAPTURE_MOVES[pawn][start][checker_sq])
+
+    # En passant, either capturing a checking pawn or blocking. Rare
+    # enough to check the resulting position directly.
+    ep_square = pos.ep_square
+    if ep_square:
+        captured_sq = ep_square + (SOUTH if side == WHITE else NORTH)
+        if (checkers | blocks) & ((1 << captured_sq) | (1 << ep_square)):
+            for start in squares(PAWN_ATTACKS[xside][ep_square] & pawns):
+                if is_ep_legal(pos, start):
+                    append(make_move(start, ep_square, pawn, True, ENPASSANT))
+
+    # Pawn pushes onto blocking squares
+    if blocks:
+        if side == WHITE:
+            single_pushes = (pawns >> 8) & ~occupied
+            double_pushes = ((single_pushes & RANK_3) >> 8) & ~occupied
+            forward = NORTH
+        else:
+            single_pushes = (pawns << 8) & ~occupied
+            double_pushes = ((single_pushes & RANK_6) << 8) & ~occupied
+            forward = SOUTH
+        for end in squares(single_pushes & blocks):
+            start = end - forward
+            if pin_masks[start] & (1 << end):
+                if (1 << end) & last_rank:
+                    for promotion in promotions:
+                        append(make_move(start, end, pawn, flag=promotion))
+                else:
+                    append(QUIET_MOVES[pawn][start][end])
+        for end in squares(double_pushes & blocks):
+            start = end - 2 * forward
+            if pin_masks[start] & (1 << end):
+                append(make_move(start, end, pawn, flag=DOUBLE))
+
+    # Other pieces capturing the checker or blocking, found by looking
+    # back from each target square
+    knights = bitboards[KNIGHT + side]
+    diagonal = bitboards[BISHOP + side] | bitboards[QUEEN + side]
+    straight = bitboards[ROOK + side] | bitboards[QUEEN + side]
+    for end in squares(checkers | blocks):
+        bishop_rays, rook_rays = pos.rays(end)
+        capture = end == checker_sq
+        for start in squares(
+            KNIGHT_ATTACKS[end] & knights
+            | bishop_rays & diagonal
+            | rook_rays & straight
+        ):
+            if pin_masks[start] & (1 << end):
+                if capture:
+                    append(CAPTURE_MOVES[board[start]][start][end])
+                else:
+                    append(QUIET_MOVES[board[start]][start][end])
+
+    return moves
+
+# Victims from most to least valuable, attackers the other way round
+VICTIMS = QUEEN, ROOK, BISHOP, KNIGHT, PAWN
+ATTACKERS = PAWN, KNIGHT, BISHOP, ROOK, QUEEN
+
+def gen_captures(pos: Position, legal: bool=True) -> iter:
+    '''
+    Lazily generates tactical moves in MVV/LVA order. Victim squares are
+    walked from the most valuable enemy piece down, and the attackers of
+    each square from the least valuable up, so nothing needs sorting.
+    En passant and quiet promotions come last. Only valid when not in
+    check. With legal=False moves are pseudo-legal.
+    '''
+
+    bitboards = pos.bitboards
+    side = pos.side
+    xside = not side
+    own = bitboards[side]
+    pin_masks = pos.pin_masks if legal else NO_PINS
+    pawn = PAWN + side
+    king = KING + side
+    king_sq = pos.king_squares[side]
+    promotions = PROMOTIONS[side]
+    last_rank = RANK_8 if side == WHITE else RANK_1
+
+    # Captures
+    for victim in VICTIMS:
+        for end in squares(bitboards[victim + xside]):
+            attackers = pos.attackers_to(end) & own
+            if not attackers:
+                continue
+            end_bb = 1 << end
+            for attacker in ATTACKERS:
+                piece = attacker + side
+                for start in squares(attackers & bitboards[piece]):
+                    if not pin_masks[start] & end_bb:
+                        continue
+                    if piece == pawn and end_bb & last_rank:
+                        for promotion in promotions:
+                            yield make_move(start, end, pawn, True, promotion)
+                    else:
+                        yield CAPTURE_MOVES[piece][start][end]
+            if (attackers & bitboards[king]
+                and not (legal and end_bb & pos.attacked)):
+                yield CAPTURE_MOVES[king][king_sq][end]
+
+    # En passant
+    ep_square = pos.ep_square
+    if ep_square:
+        for start in squares(PAWN_ATTACKS[xside][ep_square] & bitboards[pawn]):
+            if not legal or is_ep_legal(pos, start):
+                yield make_move(start, ep_square, pawn, True, ENPASSANT)
+
+    # Quiet promotions
+    if side == WHITE:
+        pushes = (bitboards[pawn] >> 8) & ~pos.occupied & last_rank
+    else:
+        pushes = (bitboards[pawn] << 8) & ~pos.occupied & last_rank
+    for end in squares(pushes):
+        start = end + (SOUTH if side == WHITE else NORTH)
+        if pin_masks[start] & (1 << end):
+            for promotion in promotions:
+                yield make_move(start, end, pawn, flag=promotion)
+
+def gen_perft(pos: Position) -> list[Move]:
     '''Generate all moves for perft purposes.'''
 
-    # Tacticals
-    for move in gen_tacticals(pos):
-        yield move
-    # Quiets
-    for move in gen_quiets(pos):
-        yield move
+    return gen_quiets(pos, gen_tacticals(pos))
+
+def gen_pseudo_legal(pos: Position) -> list[Move]:
+    '''
+    Generate all moves without pin and king safety checks. Evasions are
+    always legal, other moves need is_pseudo_legal_move_legal.
+    '''
+
+    if pos.in_check:
+        return gen_evasions(pos)
+
+    return gen_quiets(pos, gen_tacticals(pos, legal=False), legal=False)
+
+def is_pseudo_legal_move_legal(pos: Position, move: Move) -> bool:
+    '''
+    Whether a pseudo-legal move leaves the king safe. Only valid when not
+    in check. Pins are only looked for when the moving piece is on a line
+    with the king and leaves it.
+    '''
+
+    bitboards = pos.bitboards
+    side = pos.side
+    xside = not side
+    start = move_start(move)
+    end = move_end(move)
+    king_sq = pos.king_squares[side]
+
+    # King moves. Castling paths are checked when generated. Nothing
+    # attacks through the king when not in check, so the attackers of the
+    # end square don't change when the king leaves.
+    if start == king_sq:
+        return (move_flag(move) is CASTLE
+                or not pos.attackers_to(end) & bitboards[xside])
+
+    if move_flag(move) is ENPASSANT:
+        return is_ep_legal(pos, start)
+
+    # Not on a line with the king, or moving along it
+    line = LINES[king_sq][start]
+    if not line or line & (1 << end):
+        return True
+
+    # Is there an enemy slider behind the piece on the line?
+    occupied = pos.occupied ^ (1 << start)
+    if rank_of(start) == rank_of(king_sq) or file_of(start) == file_of(king_sq):
+        pinners = rook_attacks(king_sq, occupied) & (
+            bitboards[ROOK + xside] | bitboards[QUEEN + xside]
+        )
+    else:
+        pinners = bishop_attacks(king_sq, occupied) & (
+            bitboards[BISHOP + xside] | bitboards[QUEEN + xside]
+        )
 
-def is_legal(pos, move):
+    return not pinners & line
+
+# Castling right, squares that must be empty and squares that must not
+# be attacked, by castling king destination
+CASTLING_RULES = {
+    G1: (0x1, (1 << F1) | (1 << G1), 0x7000000000000000),
+    C1: (0x2, (1 << B1) | (1 << C1) | (1 << D1), 0x1c00000000000000),
+    G8: (0x4, (1 << F8) | (1 << G8), 0x70),
+    C8: (0x8, (1 << B8) | (1 << C8) | (1 << D8), 0x1c),
+}
+
+def is_legal(pos: Position, move: Move) -> bool:
+    '''
+    Whether a move from outside the move generator (TT, killer or counter
+    move) is legal in the position. Every move type is validated with
+    bitboard tests, nothing is generated.
+    '''
 
     if move is NULL_MOVE:
         return False
 
     board = pos.board
+    side = pos.side
     piece = move_piece(move)
     start = move_start(move)
     end = move_end(move)
+    flag = move_flag(move)
 
-    if piece != board[start] or piece % 2 != pos.side:
+    if piece != board[start] or piece % 2 != side:
         return False
 
-    if move_flag(move):
-        gen_moves = gen_tacticals if is_tactical(move) else gen_quiets
-        for legal_move in gen_moves(pos):
-            if move == legal_move:
-                return True
-        return False
+    end_bb = 1 << end
+    piece_type = piece & ~0x1
 
-    if bool(is_capture(move)) != bool(board[end]):
+    # Castling
+    if flag is CASTLE:
+        if piece_type is not KING or end not in CASTLING_RULES:
+            return False
+        right, empty, safe = CASTLING_RULES[end]
+        return bool(pos.castling & right
+                    and not empty & pos.occupied
+                    and not safe & pos.attacked)
+
+    # En passant
+    if flag is ENPASSANT:
+        return bool(piece_type is PAWN
+                    and pos.ep_square
+                    and end == pos.ep_square
+                    and is_capture(move)
+                    and PAWN_ATTACKS[side][start] & end_bb
+                    and is_ep_legal(pos, start))
+
+    # The capture bit has to match an enemy piece on the end square
+    if is_capture(move):
+        if not end_bb & pos.bitboards[not side]:
+            return False
+    elif board[end]:
         return False
 
-    piece_type = piece & ~0x1
-
     if piece_type is KING:
-        return (1 << end) & ~pos.bitboards[pos.side] & ~pos.attacked
+        return bool(not flag and KING_ATTACKS[start] & end_bb & ~pos.attacked)
 
-    if piece_type is PAWN:
-        if is_capture(move):
-            return ((1 << end) & pos.bitboards[not pos.side]
-                    & pos.pin_masks[start] & pos.check_mask)
-        else:
-            return ((1 << end) & ~pos.occupied
-                    & pos.pin_masks[start] & pos.check_mask)
+    # Only king moves if more than one checker
+    if bits(pos.checkers) > 1:
+        return False
 
-    if piece_type is KNIGHT:
-        return ((1 << end) & ~pos.bitboards[pos.side]
-                & pos.pin_masks[start] & pos.check_mask)
+    if piece_type is PAWN:
+        # Promote exactly when reaching the last rank
+        if end_bb & (RANK_8 | RANK_1):
+            if flag not in PROMOTIONS[side]:
+                return False
+        elif flag and flag is not DOUBLE:
+            return False
 
-    if piece_type is BISHOP:
-        return (bishop_attacks(start, pos.occupied) & ~pos.bitboards[pos.side]
-                & pos.pin_masks[start] & pos.check_mask & (1 << end))
+        push = NORTH if side == WHITE else SOUTH
 
-    if piece_type is ROOK:
-        return (rook_attacks(start, pos.occupied) & ~pos.bitboards[pos.side]
-                & pos.pin_masks[start] & pos.check_mask & (1 << end))
+        if is_capture(move):
+            if flag is DOUBLE or not PAWN_ATTACKS[side][start] & end_bb:
+                return False
+        elif flag is DOUBLE:
+            if (end != start + 2 * push
+                or board[start + push]
+                or not (1 << start) & (RANK_2 if side == WHITE else RANK_7)):
+                return False
+        elif end != start + push:
+            return False
+
+        return bool(end_bb & pos.pin_masks[start] & pos.check_mask)
+
+    if flag:
+        return False
 
-    if piece_type is QUEEN:
-        return (queen_attacks(start, pos.occupied) & ~pos.bitboards[pos.side]
-                & pos.pin_masks[start] & pos.check_mask & (1 << end))
+    if piece_type is KNIGHT:
+        return bool(KNIGHT_ATTACKS[start] & end_bb
+                    & pos.pin_masks[start] & pos.check_mask)
 
+    # Sliders
+    pos.attacks_by(side)
+    return bool(pos.attack_map.piece_attacks[start] & end_bb
+                & pos.pin_masks[start] & pos.check_mask)
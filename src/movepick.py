@@ -1,5 +1,4 @@
 from __future__ import annotations
-from functools import cached_property, partial
 
 from defs import *
 from move import *
@@ -15,17 +14,50 @@ PHASES = (
     PLAY_BAD_TACTICALS,
 ) = range(5)
 
-sort_scored = partial(sorted, key=lambda scored: scored[1], reverse=True)
+# Moves selected one at a time before the rest of a stage is sorted
+SELECTED_MOVES = 3
+
+def pick_moves(moves: list[Move], scores: list[int]) -> iter:
+    '''
+    Yields moves with their scores, best first. Ties go to the move that
+    comes first, as in a stable sort. Most nodes cut off after a move or
+    two, so the first moves are selected one at a time and the rest are
+    only sorted when they are needed.
+    '''
+
+    for _ in range(SELECTED_MOVES):
+        if not moves:
+            return
+        best = scores.index(max(scores))
+        yield moves.pop(best), scores.pop(best)
+
+    for i in sorted(range(len(scores)), key=scores.__getitem__, reverse=True):
+        yield moves[i], scores[i]
 
 class MovePicker:
+    '''
+    Hands out moves in stages. Each stage keeps its moves and scores in
+    parallel lists and selects the best remaining move only when it is
+    asked for, so a node that cuts off early never sorts the rest.
+    The quiet history of the current quiet move is kept in
+    quiet_history for the search.
+    '''
 
-    def __init__(self, pos: Position, data: SearchData):
+    def __init__(self, pos: Position, data: SearchData,
+                 pseudo_legal: bool=False):
 
         self.phase = INIT_MOVE_PICKER
         
         self.pos = pos
         self.data = data
 
+        # Generate pseudo-legal moves outside of check. The caller checks
+        # them with is_pseudo_legal_move_legal before making them.
+        self.pseudo_legal = pseudo_legal
+
+        # Quiet history of the last quiet move handed out
+        self.quiet_history = 0
+
         # Killers
         self.k1 = data.stack[0].killers[0]
         self.k2 = data.stack[0].killers[1]
@@ -49,19 +81,49 @@ class MovePicker:
         self.phase = PLAY_TT_MOVE
         
         if not quiescence and is_legal(pos, tt_move):
+            if not is_tactical(tt_move):
+                self.quiet_history = get_quiet_history(pos, data, tt_move)
             yield tt_move
 
+        # In check only evasions are generated. Captures of the checker
+        # come first, then quiet evasions by history.
+        if in_check:
+            tacticals, tactical_scores, quiets, quiet_scores = (
+                self.score_evasions()
+            )
+
+            self.phase = PLAY_GOOD_TACTICALS
+            for move, _ in pick_moves(tacticals, tactical_scores):
+                if quiescence or move != tt_move:
+                    yield move
+
+            self.phase = PLAY_QUIETS
+            for move, score in pick_moves(quiets, quiet_scores):
+                if quiescence or move != tt_move:
+                    self.quiet_history = score
+                    yield move
+
+            return
+
         # Play good tactical phase
         self.phase = PLAY_GOOD_TACTICALS
         
         bad_tacticals = []
+        bad_scores = []
         
+        # Quiescence usually stops after the first capture or two, so it
+        # takes captures lazily in MVV/LVA order instead of scoring all of
+        # them
+        if quiescence:
+            tacticals = gen_captures(pos, not self.pseudo_legal)
+        else:
+            tacticals = self.picked_tacticals()
+
         # Loop through all tacticals
-        for move, _ in self.scored_tacticals:
-            # Calculate static exchange evaluation
-            see_value = see(pos, move)
-            # Add bad tactical to bad_tacticals
-            if see_value < cutoff:
+        for move in tacticals:
+            # Add bad tactical to bad_tacticals, ordered by its static
+            # exchange evaluation
+            if not see_ge(pos, move, cutoff):
                 if cutoff <= 0:
                     attacker = move_piece(move) & ~0x1
                     if move_flag(move) is ENPASSANT:
@@ -71,11 +133,13 @@ class MovePicker:
                     else:
                         victim = -1
                     if attacker > victim:
-                        bad_tacticals.insert(0, (move, see_value))
+                        bad_tacticals.append(move)
+                        bad_scores.append(see(pos, move))
                     else:
                         yield move
                 else:
-                    bad_tacticals.insert(0, (move, see_value))
+                    bad_tacticals.append(move)
+                    bad_scores.append(see(pos, move))
             # Play good tactical move
             else:
                 yield move
@@ -87,60 +151,83 @@ class MovePicker:
             # Killer 1
             k1 = self.k1
             if k1 != tt_move and is_legal(pos, k1):
+                self.quiet_history = get_quiet_history(pos, data, k1)
                 yield k1
             # Killer 2
             k2 = self.k2
             if k2 != tt_move and is_legal(pos, k2):
+                self.quiet_history = get_quiet_history(pos, data, k2)
                 yield k2
             # Play counter
             counter = self.counter
             if counter not in (tt_move, k1, k2) and is_legal(pos, counter):
+                self.quiet_history = get_quiet_history(pos, data, counter)
                 yield counter
 
-        if not quiescence or in_check:
-            # Loop through scored quiets
-            for move, _ in self.scored_quiets:
-                # Play quiet if it is not a killer/counter/tt_move
-                if (in_check
-                    or move not in (self.k1, self.k2, self.counter, tt_move)):
+            quiets, scores = self.score_quiets()
+            special = (self.k1, self.k2, self.counter, tt_move)
+            # Play quiets by history if not a killer/counter/tt_move
+            for move, score in pick_moves(quiets, scores):
+                if move not in special:
+                    self.quiet_history = score
                     yield move
 
         # Play bad tacticals phase
         self.phase = PLAY_BAD_TACTICALS
-        
-        # Loop through bad tacticals
-        for move, _ in sort_scored(bad_tacticals):
-            if in_check or move is not tt_move:
+
+        # Bad tacticals found last are tried first among equal scores
+        bad_tacticals.reverse()
+        bad_scores.reverse()
+
+        for move, _ in pick_moves(bad_tacticals, bad_scores):
+            if move is not tt_move:
                 yield move
-        
-    @property
-    def scored_quiets(self) -> list:
-        '''Sorted quiets based on history.'''
+
+    def score_evasions(self) -> tuple[list, list, list, list]:
+        '''Tactical and quiet check evasions with their scores.'''
 
         pos = self.pos
         data = self.data
-        
-        scored_quiets = []  # (move, score)
-        
-        for move in gen_quiets(pos):
-            score = get_quiet_history(pos, data, move)
-            scored_quiets.append((move, score))
+        board = pos.board
+
+        tacticals, tactical_scores = [], []
+        quiets, quiet_scores = [], []
+
+        for move in gen_evasions(pos):
+            if is_tactical(move):
+                tacticals.append(move)
+                tactical_scores.append(
+                    PIECE_VALUES[board[move_end(move)]] * 32
+                    + get_tactical_history(pos, data, move)
+                )
+            else:
+                quiets.append(move)
+                quiet_scores.append(get_quiet_history(pos, data, move))
 
-        return sort_scored(scored_quiets)
+        return tacticals, tactical_scores, quiets, quiet_scores
 
-    @cached_property
-    def scored_tacticals(self) -> list:
-        '''Sorted tacticals based on history.'''
+    def score_quiets(self) -> tuple[list, list]:
+        '''Quiets with their history scores.'''
 
         pos = self.pos
         data = self.data
-        board = pos.board
 
-        scored_tacticals = []  # (move, score)
+        quiets = gen_quiets(pos, legal=not self.pseudo_legal)
+        scores = [get_quiet_history(pos, data, move) for move in quiets]
+
+        return quiets, scores
+
+    def picked_tacticals(self) -> iter:
+        '''Tacticals by victim value and tactical history.'''
+
+        pos = self.pos
+        data = self.data
+        board = pos.board
 
-        for move in gen_tacticals(pos):
-            score = (PIECE_VALUES[board[move_end(move)]] * 32
-                     + get_tactical_history(pos, data, move))
-            scored_tacticals.append((move, score))
+        tacticals = gen_tacticals(pos, legal=not self.pseudo_legal)
+        scores = [PIECE_VALUES[board[move_end(move)]] * 32
+                  + get_tactical_history(pos, data, move)
+                  for move in tacticals]
 
-        return sort_scored(scored_tacticals)       
+        for move, _ in pick_moves(tacticals, scores):
+            yield move
@@ -0,0 +1,56 @@
+'''
+NumPy backend of the NNUE, see set_nnue_backend. Accumulators are int32
+arrays and feature weight vectors int16 views of the network weights, so
+updates and the forward pass are vectorized. NumPy is optional, the
+engine itself only needs the standard library.
+'''
+
+import numpy as np
+
+from bitboard import squares
+from defs import *
+from nnue import (FEATURE_WEIGHTS, HIDDEN_BIASES, N_HIDDEN,
+                  OUR_HIDDEN_WEIGHTS, THEIR_HIDDEN_WEIGHTS,
+                  FW_VECTORS, feature_index)
+
+# Feature weights without a copy of the int16 buffer
+FEATURE_MATRIX = np.frombuffer(FEATURE_WEIGHTS, dtype=np.int16)
+
+ACCUMULATOR_BIASES = np.array(HIDDEN_BIASES, dtype=np.int32)
+
+# Products are summed in 64 bits so the output is exact
+OUR_WEIGHTS = np.array(OUR_HIDDEN_WEIGHTS, dtype=np.int64)
+THEIR_WEIGHTS = np.array(THEIR_HIDDEN_WEIGHTS, dtype=np.int64)
+
+def fw_vectors() -> tuple[dict, dict]:
+    '''Feature weight vectors indexed by [color][(piece, square)].'''
+
+    fw_vectors = dict(), dict()
+
+    for color in (WHITE, BLACK):
+        for piece in PIECES[2:]:
+            for square in range(64):
+                i = feature_index(color, piece, square)
+                fw_vectors[color][(piece, square)] = (
+                    FEATURE_MATRIX[i:i+N_HIDDEN]
+                )
+
+    return fw_vectors
+
+def make_accumulation(color: Color, board: list[Piece],
+                      occupied: Bitboard) -> np.ndarray:
+    '''Accumulation of one perspective.'''
+
+    vectors = FW_VECTORS[color]
+    features = [vectors[(board[square], square)]
+                for square in squares(occupied)]
+    if not features:
+        return ACCUMULATOR_BIASES.copy()
+
+    return ACCUMULATOR_BIASES + np.sum(features, axis=0, dtype=np.int32)
+
+def hidden_output(ours: np.ndarray, theirs: np.ndarray) -> int:
+    '''Hidden layer output before the output bias and scaling.'''
+
+    return (int(np.dot(np.maximum(ours, 0), OUR_WEIGHTS))
+            + int(np.dot(np.maximum(theirs, 0), THEIR_WEIGHTS)))
@@ -4,21 +4,38 @@ from defs import *
 from movegen import *
 from position import *
 
-def perft(pos: Position, depth: int) -> int:
+def perft(pos: Position, depth: int, make_unmake: bool=False,
+          pseudo_legal: bool=False) -> int:
 
     nodes = 0
 
-    if depth == 1:
-        return len(list(gen_perft(pos)))
     if depth == 0:
         return 1
 
-    for move in gen_perft(pos):
-        nodes += perft(do_move(pos, move), depth - 1)
+    if pseudo_legal:
+        moves = gen_pseudo_legal(pos)
+        if not pos.in_check:
+            moves = [move for move in moves
+                     if is_pseudo_legal_move_legal(pos, move)]
+    else:
+        moves = gen_perft(pos)
+
+    if depth == 1:
+        return len(moves)
+
+    if make_unmake:
+        for move in moves:
+            nodes += perft(apply_move(pos, move), depth - 1, True,
+                           pseudo_legal)
+            undo_move(pos)
+    else:
+        for move in moves:
+            nodes += perft(do_move(pos, move), depth - 1, False,
+                           pseudo_legal)
 
     return nodes
 
-def perft_divide(pos: Position, depth: int) -> None:
+def perft_divide(pos: Position, depth: int, make_unmake: bool=False) -> None:
 
     start = time()
     nodes = 0
@@ -26,7 +43,11 @@ def perft_divide(pos: Position, depth: int) -> None:
     assert depth >= 1
 
     for move in gen_perft(pos):
-        count = perft(do_move(pos, move), depth - 1)
+        if make_unmake:
+            count = perft(apply_move(pos, move), depth - 1, True)
+            undo_move(pos)
+        else:
+            count = perft(do_move(pos, move), depth - 1)
         nodes += count
         print(f'{move_to_str(move)}: {count}')
 
@@ -1,5 +1,6 @@
-from dataclasses import dataclass
-from functools import cached_property
+from __future__ import annotations
+
+from random import Random
 
 from bitboard import *
 from defs import *
@@ -35,6 +36,73 @@ UPDATE_CASTLING_KEYS = (
     13, 15, 15, 15, 12, 15, 15, 14,
 )
 
+ZOBRIST_PIECES = zeros(14, 64)
+ZOBRIST_CASTLING = zeros(16)
+ZOBRIST_EP = zeros(64)
+
+# Initialize zobrist keys. A fixed seed keeps keys (and therefore
+# transposition table behaviour) reproducible between runs.
+rng = Random(0x0D405E)
+for piece in PIECES[2:]:
+    for square in range(64):
+        ZOBRIST_PIECES[piece][square] = rng.getrandbits(64)
+# No castling rights and no en passant square hash to zero
+for castling in range(1, 16):
+    ZOBRIST_CASTLING[castling] = rng.getrandbits(64)
+for square in range(1, 64):
+    ZOBRIST_EP[square] = rng.getrandbits(64)
+ZOBRIST_SIDE = rng.getrandbits(64)
+
+# Cuckoo tables of the key differences of reversible piece moves, used to
+# detect upcoming repetitions. See Marcel van Kervinck's paper on cycle
+# detection and Stockfish's implementation.
+CUCKOO_KEYS = zeros(8192)
+CUCKOO_MOVES = zeros(8192)
+
+def cuckoo_h1(key: Key) -> int:
+    return key & 0x1FFF
+
+def cuckoo_h2(key: Key) -> int:
+    return (key >> 16) & 0x1FFF
+
+# Initialize cuckoo tables
+for piece in PIECES[WHITE_KNIGHT:]:
+    piece_type = piece & ~0x1
+    for start in range(64):
+        if piece_type is KNIGHT:
+            targets = KNIGHT_ATTACKS[start]
+        elif piece_type is BISHOP:
+            targets = bishop_attacks(start, 0)
+        elif piece_type is ROOK:
+            targets = rook_attacks(start, 0)
+        elif piece_type is QUEEN:
+            targets = queen_attacks(start, 0)
+        else:
+            targets = KING_ATTACKS[start]
+        # Only one of a move and its reverse is stored
+        targets &= ~((1 << (start + 1)) - 1)
+        for end in squares(targets):
+            key = (ZOBRIST_PIECES[piece][start] ^ ZOBRIST_PIECES[piece][end]
+                   ^ ZOBRIST_SIDE)
+            move = make_move(start, end, piece)
+            # Insert, kicking out entries to their other slot until an
+            # empty slot is found
+            i = cuckoo_h1(key)
+            while True:
+                CUCKOO_KEYS[i], key = key, CUCKOO_KEYS[i]
+                CUCKOO_MOVES[i], move = move, CUCKOO_MOVES[i]
+                if not move:
+                    break
+                i = cuckoo_h2(key) if i == cuckoo_h1(key) else cuckoo_h1(key)
+
+# Rook start, rook end and rook indexed by king end square of a castle
+CASTLING_ROOK_MOVES = {
+    G1: (H1, F1, WHITE_ROOK),
+    C1: (A1, D1, WHITE_ROOK),
+    G8: (H8, F8, BLACK_ROOK),
+    C8: (A8, D8, BLACK_ROOK),
+}
+
 INSUFFICIENT_MATERIAL = {
     MATERIAL_KEYS[0],  # Kk
     MATERIAL_KEYS[WHITE_KNIGHT],  # KNk
@@ -47,33 +115,156 @@ INSUFFICIENT_MATERIAL = {
     MATERIAL_KEYS[WHITE_BISHOP] + MATERIAL_KEYS[BLACK_BISHOP],  # KBkb
 }
 
-@dataclass
+class AttackMap:
+    '''
+    Attacks of the pieces in a position for the current occupancy. Each
+    side is filled in the first time it is asked for, and attackers to a
+    square are remembered once looked up.
+    '''
+
+    __slots__ = ('piece_attacks', 'side_attacks', 'attackers', 'rays')
+
+    def __init__(self) -> None:
+        self.piece_attacks = [0]*64       # Attacks of the non-pawn on a square
+        self.side_attacks = [None, None]  # All squares attacked by a side
+        self.attackers = {}               # Attackers of both sides to a square
+        self.rays = {}                    # Bishop and rook attacks from a square
+
+class Accumulator:
+    '''
+    NNUE accumulator of a position. A move only records the features it
+    adds and removes with a link to the accumulator before it. The values
+    are computed when an evaluation asks for them, see accumulator_values.
+    '''
+
+    __slots__ = ('parent', 'added', 'removed', 'values')
+
+    def __init__(self, parent: Accumulator, added: tuple, removed: tuple,
+                 values: list=None) -> None:
+        self.parent = parent    # Accumulator before the move
+        self.added = added      # (piece, square) features added by the move
+        self.removed = removed  # (piece, square) features removed by the move
+        self.values = values    # Accumulation of each perspective once computed
+
 class Position:
     '''Class for storing information regarding board representation.'''
 
-    # Board representation
-    board: list[Piece]
-    bitboards: list[Bitboard]
-    side: Color
-    castling: Key
-    ep_square: Square
+    __slots__ = (
+        # Board representation
+        'board', 'bitboards', 'occupied', 'king_squares',
+        'side', 'castling', 'ep_square',
+        # Used for the engine
+        'key', 'material_key', 'rule_50', 'game_ply', 'key_history',
+        'accumulator', 'undo_stack',
+        # Lazily computed attacks. None until first used.
+        '_attacked', '_checkers', '_check_mask', '_pin_masks',
+        '_check_info', '_attack_map',
+    )
 
-    # Used for the engine
-    material_key: Key
-    previous: set
-    accumulator: list[list[int]]
+    def __init__(self, board: list[Piece], bitboards: list[Bitboard],
+                 occupied: Bitboard, king_squares: tuple[Square, Square],
+                 side: Color, castling: Key, ep_square: Square, key: Key,
+                 material_key: Key, rule_50: int, game_ply: int,
+                 key_history: list[Key], accumulator: Accumulator,
+                 undo_stack: list[tuple]) -> None:
+
+        # Board representation
+        self.board = board
+        self.bitboards = bitboards
+        self.occupied = occupied
+        self.king_squares = king_squares
+        self.side = side
+        self.castling = castling
+        self.ep_square = ep_square
+
+        # Used for the engine
+        self.key = key
+        self.material_key = material_key
+        self.rule_50 = rule_50
+        self.game_ply = game_ply
+        self.key_history = key_history
+        self.accumulator = accumulator
+        self.undo_stack = undo_stack
+
+        # Lazily computed attacks
+        self._attacked = None
+        self._checkers = None
+        self._check_mask = None
+        self._pin_masks = None
+        self._check_info = None
+        self._attack_map = None
 
     @property
-    def occupied(self) -> Bitboard:
-        return self.bitboards[WHITE] | self.bitboards[BLACK]
+    def is_repeated(self) -> bool:
+        '''
+        Scans the key history for an earlier occurrence of this position.
+        Only positions with the same side to move since the last
+        irreversible move can be repetitions.
+        '''
 
-    @property
-    def rule_50(self) -> int:
-        return len(self.previous)
+        key = self.key
+        key_history = self.key_history
+        ply = self.game_ply
+        end = ply - min(self.rule_50, ply)
 
-    @property
-    def is_repeated(self) -> bool:
-        return self.__hash__() in self.previous
+        for i in range(ply - 4, end - 1, -2):
+            if key_history[i] == key:
+                return True
+
+        return False
+
+    def has_upcoming_repetition(self, ply: int) -> bool:
+        '''
+        Whether the side to move has a reversible move that reaches an
+        earlier position, so the node is at least a draw. Ply is the
+        search ply, used to tell the search tree apart from the game
+        history.
+        '''
+
+        end = min(self.rule_50, self.game_ply)
+        if end < 3:
+            return False
+
+        key = self.key
+        key_history = self.key_history
+        game_ply = self.game_ply
+        occupied = self.occupied
+        board = self.board
+
+        for i in range(3, end + 1, 2):
+            move_key = key ^ key_history[game_ply - i]
+
+            j = cuckoo_h1(move_key)
+            if CUCKOO_KEYS[j] != move_key:
+                j = cuckoo_h2(move_key)
+                if CUCKOO_KEYS[j] != move_key:
+                    continue
+
+            move = CUCKOO_MOVES[j]
+            start = move_start(move)
+            end_sq = move_end(move)
+
+            # The path of the move must be clear
+            if BETWEEN[start][end_sq] & occupied:
+                continue
+
+            # The cycle is inside the search tree
+            if ply > i:
+                return True
+
+            # Otherwise the piece must be ours and the earlier position
+            # must already have been repeated once
+            piece = board[start] if board[start] != NO_PIECE else board[end_sq]
+            if piece & 0x1 != self.side:
+                continue
+
+            earlier = game_ply - i
+            repeated_key = key_history[earlier]
+            for k in range(earlier - 4, game_ply - end - 1, -2):
+                if key_history[k] == repeated_key:
+                    return True
+
+        return False
 
     @property
     def is_material_draw(self) -> bool:
@@ -81,126 +272,268 @@ class Position:
     
     @property
     def in_check(self) -> bool:
-        return self.attacked & self.bitboards[KING + self.side]
+        return self.checkers != 0
         
-    @cached_property
-    def attacked(self) -> Bitboard:
-        '''Which squares the side not to move attacks.'''
-        
-        side = self.side
-        xside = not side
+    @property
+    def attack_map(self) -> AttackMap:
+        if self._attack_map is None:
+            self._attack_map = AttackMap()
+        return self._attack_map
+
+    def attacks_by(self, color: Color) -> Bitboard:
+        '''
+        Squares attacked by a side. Also fills in the attacks of each of
+        its pieces other than pawns in the attack map.
+        '''
+
+        attack_map = self.attack_map
+        side_attacks = attack_map.side_attacks[color]
+        if side_attacks is not None:
+            return side_attacks
+
+        piece_attacks = attack_map.piece_attacks
         bitboards = self.bitboards
-        no_king_occupancy = self.occupied ^ bitboards[KING + side]
-        attacked = 0
+        occupied = self.occupied
+        side_attacks = 0
 
-        # Squares attacked by enemy pawns
-        if side == WHITE:
-            attacked |= (bitboards[BLACK_PAWN] << 7) & ~H_FILE 
-            attacked |= (bitboards[BLACK_PAWN] << 9) & ~A_FILE 
+        # Pawn attacks, all at once
+        if color == WHITE:
+            side_attacks |= (bitboards[WHITE_PAWN] >> 7) & ~A_FILE
+            side_attacks |= (bitboards[WHITE_PAWN] >> 9) & ~H_FILE
         else:
-            attacked |= (bitboards[WHITE_PAWN] >> 7) & ~A_FILE 
-            attacked |= (bitboards[WHITE_PAWN] >> 9) & ~H_FILE 
-
-        # Squares attacked by enemy knights
-        bitboard = bitboards[KNIGHT + xside]
-        while bitboard:
-            square = msb(bitboard)
-            attacked |= KNIGHT_ATTACKS[square]
-            bitboard ^= 1 << square
-
-        # Squares attacked by enemy king
-        attacked |= KING_ATTACKS[msb(bitboards[KING + xside])]
-
-        # Squares attacked by enemy diagonal sliders
-        bitboard = bitboards[BISHOP + xside] | bitboards[QUEEN + xside]
-        while bitboard:
-            square = msb(bitboard)
-            attacked |= bishop_attacks(square, no_king_occupancy)
-            bitboard ^= 1 << square
-
-        # Squares attacked by enemy straight sliders
-        bitboard = bitboards[ROOK + xside] | bitboards[QUEEN + xside]
-        while bitboard:
-            square = msb(bitboard)
-            attacked |= rook_attacks(square, no_king_occupancy)
-            bitboard ^= 1 << square
+            side_attacks |= (bitboards[BLACK_PAWN] << 7) & ~H_FILE
+            side_attacks |= (bitboards[BLACK_PAWN] << 9) & ~A_FILE
+
+        # Knight attacks
+        for square in squares(bitboards[KNIGHT + color]):
+            attacks = piece_attacks[square] = KNIGHT_ATTACKS[square]
+            side_attacks |= attacks
+
+        # Diagonal slider attacks
+        for square in squares(bitboards[BISHOP + color]):
+            attacks = piece_attacks[square] = (
+                BISHOP_ATTACKS[square][occupied & BISHOP_MASKS[square]]
+            )
+            side_attacks |= attacks
+
+        # Straight slider attacks
+        for square in squares(bitboards[ROOK + color]):
+            attacks = piece_attacks[square] = (
+                ROOK_ATTACKS[square][occupied & ROOK_MASKS[square]]
+            )
+            side_attacks |= attacks
+
+        # Queen attacks
+        for square in squares(bitboards[QUEEN + color]):
+            attacks = piece_attacks[square] = (
+                BISHOP_ATTACKS[square][occupied & BISHOP_MASKS[square]]
+                | ROOK_ATTACKS[square][occupied & ROOK_MASKS[square]]
+            )
+            side_attacks |= attacks
+
+        # King attacks
+        square = self.king_squares[color]
+        attacks = piece_attacks[square] = KING_ATTACKS[square]
+        side_attacks |= attacks
+
+        attack_map.side_attacks[color] = side_attacks
+        return side_attacks
+
+    def rays(self, square: Square) -> tuple[Bitboard, Bitboard]:
+        '''Bishop and rook attacks from a square.'''
+
+        rays = self.attack_map.rays
+        if square in rays:
+            return rays[square]
+
+        occupied = self.occupied
+        rays[square] = ray = (
+            BISHOP_ATTACKS[square][occupied & BISHOP_MASKS[square]],
+            ROOK_ATTACKS[square][occupied & ROOK_MASKS[square]],
+        )
+        return ray
+
+    def attackers_to(self, square: Square) -> Bitboard:
+        '''Pieces of both sides that attack a square.'''
+
+        attackers = self.attack_map.attackers
+        if square in attackers:
+            return attackers[square]
+
+        bitboards = self.bitboards
+        bishop_rays, rook_rays = self.rays(square)
+        attackers[square] = square_attackers = (
+            PAWN_ATTACKS[WHITE][square] & bitboards[BLACK_PAWN]
+            | PAWN_ATTACKS[BLACK][square] & bitboards[WHITE_PAWN]
+            | KNIGHT_ATTACKS[square]
+            & (bitboards[WHITE_KNIGHT] | bitboards[BLACK_KNIGHT])
+            | KING_ATTACKS[square]
+            & (bitboards[WHITE_KING] | bitboards[BLACK_KING])
+            | bishop_rays
+            & (bitboards[WHITE_BISHOP] | bitboards[BLACK_BISHOP]
+               | bitboards[WHITE_QUEEN] | bitboards[BLACK_QUEEN])
+            | rook_rays
+            & (bitboards[WHITE_ROOK] | bitboards[BLACK_ROOK]
+               | bitboards[WHITE_QUEEN] | bitboards[BLACK_QUEEN])
+        )
+        return square_attackers
 
+    @property
+    def attacked(self) -> Bitboard:
+        '''
+        Which squares the side not to move attacks. Sliders checking the
+        king also attack the squares behind it.
+        '''
+
+        if self._attacked is not None:
+            return self._attacked
+
+        side = self.side
+        xside = not side
+        bitboards = self.bitboards
+        attacked = self.attacks_by(xside)
+
+        # Extend checking sliders through the king
+        sliders = (self.checkers & ~bitboards[PAWN + xside]
+                   & ~bitboards[KNIGHT + xside])
+        if sliders:
+            no_king_occupancy = self.occupied ^ bitboards[KING + side]
+            for square in squares(sliders):
+                piece = self.board[square] & ~0x1
+                if piece is not ROOK:
+                    attacked |= bishop_attacks(square, no_king_occupancy)
+                if piece is not BISHOP:
+                    attacked |= rook_attacks(square, no_king_occupancy)
+
+        self._attacked = attacked
         return attacked
 
-    @cached_property
+    @property
     def checkers(self) -> Bitboard:
-        '''Squares of pieces that are giving check.'''
-        
-        if self.in_check:
+        '''
+        Squares of pieces that are giving check. Found by looking outward
+        from the king square so the full attack map is not needed.
+        '''
 
-            side = self.side
-            xside = not side
-            bitboards = self.bitboards
-            occupied = self.occupied
-            king_sq = msb(bitboards[KING + side])
+        if self._checkers is not None:
+            return self._checkers
 
-            return (PAWN_ATTACKS[side][king_sq] & bitboards[PAWN + xside]
-                    | KNIGHT_ATTACKS[king_sq] & bitboards[KNIGHT + xside]
-                    | bishop_attacks(king_sq, occupied)
-                    & (bitboards[BISHOP + xside] | bitboards[QUEEN + xside])
-                    | rook_attacks(king_sq, occupied)
-                    & (bitboards[ROOK + xside] | bitboards[QUEEN + xside]))
+        side = self.side
+        king_sq = self.king_squares[side]
+        checkers = self.attackers_to(king_sq) & self.bitboards[not side]
 
-        return 0
+        self._checkers = checkers
+        return checkers
 
-    @cached_property
+    @property
     def check_mask(self) -> Bitboard:
         '''Used to mask out illegal moves when in check.'''
+
+        if self._check_mask is not None:
+            return self._check_mask
         
         checkers = self.checkers
         
         if checkers:
-            king = KING + self.side
-            return BETWEEN[msb(checkers)][msb(self.bitboards[king])] | checkers
-        
-        return -1
+            king_sq = self.king_squares[self.side]
+            check_mask = BETWEEN[msb(checkers)][king_sq] | checkers
+        else:
+            check_mask = -1
+
+        self._check_mask = check_mask
+        return check_mask
 
-    @cached_property
+    @property
     def pin_masks(self) -> list[Bitboard]:
         '''
         Masks out illegal moves for pinned pieces. This idea was
         inspired by Gigantua.
         '''
+
+        if self._pin_masks is not None:
+            return self._pin_masks
         
         side = self.side
         xside = not side
         bitboards = self.bitboards
         occupied = self.occupied
-        king_sq = msb(bitboards[KING + side])
+        king_sq = self.king_squares[side]
+        bishop_rays, rook_rays = self.rays(king_sq)
         pin_masks = [-1]*64
 
         # Horizontal and vertical pins
         pinners = (
-            rook_attacks(king_sq, occupied & ~rook_attacks(king_sq, occupied))
+            rook_attacks(king_sq, occupied & ~rook_rays)
             & (bitboards[ROOK + xside] | bitboards[QUEEN + xside])
         )
-        while pinners:
-            pinner_sq = msb(pinners)
+        for pinner_sq in squares(pinners):
             betweens = BETWEEN[king_sq][pinner_sq]
             pin_masks[msb(betweens & occupied)] = betweens | (1 << pinner_sq)                                                
-            pinners ^= 1 << pinner_sq
 
         # Diagonal pins
         pinners = (
-            bishop_attacks(king_sq, occupied & ~bishop_attacks(king_sq, occupied))
+            bishop_attacks(king_sq, occupied & ~bishop_rays)
             & (bitboards[BISHOP + xside] | bitboards[QUEEN + xside])
         )
-        while pinners:
-            pinner_sq = msb(pinners)
+        for pinner_sq in squares(pinners):
             betweens = BETWEEN[king_sq][pinner_sq]
             pin_masks[msb(betweens & occupied)] = betweens | (1 << pinner_sq)                                                     
-            pinners ^= 1 << pinner_sq    
-        
+
+        self._pin_masks = pin_masks
         return pin_masks
 
+    @property
+    def check_info(self) -> tuple[list[Bitboard], Bitboard]:
+        '''
+        Squares from which each piece type of the side to move would check
+        the enemy king, and the pieces of the side to move that would give
+        a discovered check by moving off the line to the enemy king.
+        '''
+
+        if self._check_info is not None:
+            return self._check_info
+
+        side = self.side
+        bitboards = self.bitboards
+        occupied = self.occupied
+        king_sq = self.king_squares[not side]
+
+        # Check squares indexed by piece type
+        check_squares = zeros(14)
+        check_squares[PAWN] = PAWN_ATTACKS[not side][king_sq]
+        check_squares[KNIGHT] = KNIGHT_ATTACKS[king_sq]
+        check_squares[BISHOP], check_squares[ROOK] = self.rays(king_sq)
+        check_squares[QUEEN] = check_squares[BISHOP] | check_squares[ROOK]
+
+        # Our sliders behind exactly one piece on a line to the enemy king
+        snipers = (
+            rook_attacks(king_sq, occupied & ~check_squares[ROOK])
+            & (bitboards[ROOK + side] | bitboards[QUEEN + side])
+            | bishop_attacks(king_sq, occupied & ~check_squares[BISHOP])
+            & (bitboards[BISHOP + side] | bitboards[QUEEN + side])
+        )
+        discoverers = 0
+        for sniper_sq in squares(snipers):
+            discoverers |= BETWEEN[king_sq][sniper_sq] & occupied
+        discoverers &= bitboards[side]
+
+        self._check_info = check_squares, discoverers
+        return self._check_info
+
     def __hash__(self) -> Key:
-        return hash((*self.bitboards, not self.side, self.castling,
-                     self.ep_square)) & 0xFFFFFFFFFFFFFFFF
+        return self.key
+
+    def __repr__(self) -> str:
+        '''
+        Evaluates back to the position. Used to pass it to workers, which
+        build their own accumulator and start with an empty undo stack.
+        '''
+
+        return (f'Position({self.board}, {self.bitboards}, {self.occupied}, '
+                f'{self.king_squares}, {self.side}, {self.castling}, '
+                f'{self.ep_square}, {self.key}, {self.material_key}, '
+                f'{self.rule_50}, {self.game_ply}, {self.key_history}, '
+                f'None, [])')
 
     def __str__(self) -> str:
         
@@ -218,7 +551,7 @@ class Position:
         string += '\n    a b c d e f g h\n'
         string += '\n Side:     ' + ('Black' if self.side else 'White')
         string += '\n Castling: ' + bin(self.castling)[2:]
-        string += '\n Key:      ' + hex(self.__hash__())
+        string += '\n Key:      ' + hex(self.key)
 
         return string + '\n'
 
@@ -263,10 +596,25 @@ def as_fen(pos: Position) -> str:
     fen += ' '
 
     # Move clocks
-    fen += str(len(pos.previous)) + ' 1'
+    fen += str(pos.rule_50) + ' 1'
 
     return fen[1:]
 
+def zobrist_key(board: list[Piece], side: Color,
+                castling: Key, ep_square: Square) -> Key:
+    '''Computes the zobrist key of a position from scratch.'''
+
+    key = ZOBRIST_CASTLING[castling] ^ ZOBRIST_EP[ep_square]
+
+    if side == BLACK:
+        key ^= ZOBRIST_SIDE
+
+    for square, piece in enumerate(board):
+        if piece != NO_PIECE:
+            key ^= ZOBRIST_PIECES[piece][square]
+
+    return key
+
 def parse_fen(fen: str=STARTING_FEN) -> Position:
     '''Creates a position from a FEN.'''
     
@@ -276,8 +624,7 @@ def parse_fen(fen: str=STARTING_FEN) -> Position:
     castling = 0
     ep_square = 0
     material_key = 0
-    previous = set()
-    accumulator = zeros(2)
+    rule_50 = 0
 
     fen += ' 0 1'
     tokens = fen.split()
@@ -308,8 +655,8 @@ def parse_fen(fen: str=STARTING_FEN) -> Position:
     # En passant square
     ep_square = 0 if tokens[3] == '-' else SQUARE_NAMES.index(tokens[3])
 
-    # Add invalid keys (negative numbers) to previous for rule_50 
-    previous = {-k - 1 for k in range(int(tokens[4]))}
+    # Halfmove clock
+    rule_50 = int(tokens[4])
 
     # Initialize piece bitboards
     for square, piece in enumerate(board):
@@ -324,11 +671,65 @@ def parse_fen(fen: str=STARTING_FEN) -> Position:
         if piece != NO_PIECE:
             material_key += MATERIAL_KEYS[piece]
 
-    # Initialize accumulator
-    accumulator = make_accumulator(board)
-
-    return Position(board, bitboards, side,
-                    castling, ep_square, material_key, previous, accumulator)
+    # Set zobrist key
+    key = zobrist_key(board, side, castling, ep_square)
+
+    # Occupancy and king squares
+    occupied = bitboards[WHITE] | bitboards[BLACK]
+    king_squares = msb(bitboards[WHITE_KING]), msb(bitboards[BLACK_KING])
+
+    # The accumulator is only built once the position is searched or
+    # evaluated, see refresh_accumulator
+    return Position(board, bitboards, occupied, king_squares, side, castling,
+                    ep_square, key, material_key, rule_50, 0, [key],
+                    None, [])
+
+def refresh_accumulator(pos: Position) -> None:
+    '''
+    Builds the accumulator of a position that does not have one. Moves
+    made from such positions skip NNUE updates, which is all perft and
+    replaying moves need.
+    '''
+
+    if pos.accumulator is None:
+        pos.accumulator = Accumulator(None, (), (), [
+            refresh_accumulation(color, pos.board, pos.bitboards,
+                                 pos.king_squares[color])
+            for color in (WHITE, BLACK)
+        ])
+
+def accumulator_values(accumulator: Accumulator) -> list:
+    '''
+    Accumulation of each perspective. Pending updates are applied from
+    the nearest computed ancestor, and every accumulator on the way keeps
+    its values so its other children can start from it.
+    '''
+
+    if accumulator.values is not None:
+        return accumulator.values
+
+    # Walk back to the nearest computed ancestor
+    pending = []
+    while accumulator.values is None:
+        pending.append(accumulator)
+        accumulator = accumulator.parent
+
+    white, black = accumulator.values
+    white_vectors, black_vectors = FW_VECTORS
+
+    # Apply the updates in move order. Vectors are added left to right and
+    # never in place, which NumPy accumulators need.
+    for accumulator in reversed(pending):
+        for feature in accumulator.added:
+            white = white + white_vectors[feature]
+            black = black + black_vectors[feature]
+        for feature in accumulator.removed:
+            white = white - white_vectors[feature]
+            black = black - black_vectors[feature]
+        accumulator.values = [white, black]
+        accumulator.parent = None
+
+    return accumulator.values
 
 def has_non_pawn(pos: Position, side: Color) -> bool:
     '''Used for null-move pruning.'''
@@ -337,15 +738,172 @@ def has_non_pawn(pos: Position, side: Color) -> bool:
             ^ pos.bitboards[side + KING]
             ^ pos.bitboards[side + PAWN])
 
+def push_key(key_history: list[Key], game_ply: int, key: Key) -> None:
+    '''
+    Stores key at index game_ply of the key history, which is shared by
+    every position of the game. Entries past game_ply belong to lines
+    that have already been searched, so they are overwritten.
+    '''
+
+    if game_ply < len(key_history):
+        key_history[game_ply] = key
+    else:
+        key_history.append(key)
+
 def do_null_move(pos: Position) -> Position:
     '''Does a null move on the position using copy/make.'''
     
-    return Position([*pos.board], [*pos.bitboards], not pos.side, pos.castling,
-                    0, pos.material_key, set(), deepcopy(pos.accumulator))
+    key = pos.key ^ ZOBRIST_SIDE ^ ZOBRIST_EP[pos.ep_square]
+    game_ply = pos.game_ply + 1
+    push_key(pos.key_history, game_ply, key)
+
+    return Position([*pos.board], [*pos.bitboards], pos.occupied,
+                    pos.king_squares, not pos.side, pos.castling, 0, key,
+                    pos.material_key, 0, game_ply, pos.key_history,
+                    pos.accumulator, [])
     
 def do_move(pos: Position, move: Move) -> Position:
     '''Does a legal move on the position using copy/make.'''
 
+    new_pos = Position([*pos.board], [*pos.bitboards], pos.occupied,
+                       pos.king_squares, pos.side, pos.castling,
+                       pos.ep_square, pos.key, pos.material_key, pos.rule_50,
+                       pos.game_ply, pos.key_history, pos.accumulator, [])
+    play_move(new_pos, move)
+
+    return new_pos
+
+def apply_null_move(pos: Position) -> Position:
+    '''Does a null move on the position in place using make/unmake.'''
+
+    save_state(pos, NULL_MOVE, NO_PIECE)
+
+    pos.side = not pos.side
+    pos.key ^= ZOBRIST_SIDE ^ ZOBRIST_EP[pos.ep_square]
+    pos.ep_square = 0
+    pos.rule_50 = 0
+    pos.game_ply += 1
+    push_key(pos.key_history, pos.game_ply, pos.key)
+
+    return pos
+
+def apply_move(pos: Position, move: Move) -> Position:
+    '''Does a legal move on the position in place using make/unmake.'''
+
+    save_state(pos, move, pos.board[move_end(move)])
+    play_move(pos, move)
+
+    return pos
+
+def save_state(pos: Position, move: Move, captured: Piece) -> None:
+    '''
+    Pushes an undo record with everything a move cannot recompute when
+    it is taken back, and clears the cached attacks of the position.
+    '''
+
+    pos.undo_stack.append((move, captured, pos.castling, pos.ep_square,
+                           pos.key, pos.material_key, pos.rule_50,
+                           pos.accumulator, pos._attacked, pos._checkers,
+                           pos._check_mask, pos._pin_masks, pos._check_info,
+                           pos._attack_map))
+
+    pos._attacked = None
+    pos._checkers = None
+    pos._check_mask = None
+    pos._pin_masks = None
+    pos._check_info = None
+    pos._attack_map = None
+
+def undo_move(pos: Position) -> None:
+    '''Takes back the last move done with apply_move/apply_null_move.'''
+
+    (move, captured, castling, ep_square, key, material_key, rule_50,
+     accumulator, attacked, checkers, check_mask, pin_masks,
+     check_info, attack_map) = pos.undo_stack.pop()
+
+    # Side is side that made the move
+    side = not pos.side
+    xside = pos.side
+
+    # Restore attributes
+    pos.side = side
+    pos.castling = castling
+    pos.ep_square = ep_square
+    pos.key = key
+    pos.material_key = material_key
+    pos.rule_50 = rule_50
+    pos.game_ply -= 1
+    pos.accumulator = accumulator
+
+    # Restore cached attacks
+    pos._attacked = attacked
+    pos._checkers = checkers
+    pos._check_mask = check_mask
+    pos._pin_masks = pin_masks
+    pos._check_info = check_info
+    pos._attack_map = attack_map
+
+    if move is NULL_MOVE:
+        return
+
+    board = pos.board
+    bitboards = pos.bitboards
+
+    # Decode move
+    start = move_start(move)
+    end = move_end(move)
+    piece = move_piece(move)
+    flag = move_flag(move)
+
+    # Remove piece from end, restoring any captured piece
+    moved = flag if is_promotion(move) else piece
+    board[end] = captured
+    bitboards[moved] ^= 1 << end
+    bitboards[side] ^= 1 << end
+    if captured:
+        bitboards[captured] |= 1 << end
+        bitboards[xside] |= 1 << end
+
+    # Place piece back on start
+    board[start] = piece
+    bitboards[piece] |= 1 << start
+    bitboards[side] |= 1 << start
+    if piece & ~0x1 is KING:
+        set_king_square(pos, side, start)
+
+    # En passant capture
+    if flag is ENPASSANT:
+        ep_pawn_square = end + (NORTH, SOUTH)[xside]
+        ep_pawn = PAWN + xside
+        board[ep_pawn_square] = ep_pawn
+        bitboards[ep_pawn] |= 1 << ep_pawn_square
+        bitboards[xside] |= 1 << ep_pawn_square
+
+    # Castling
+    elif flag is CASTLE:
+        rook_start, rook_end, rook = CASTLING_ROOK_MOVES[end]
+        board[rook_end] = NO_PIECE
+        bitboards[rook] ^= 1 << rook_end
+        bitboards[side] ^= 1 << rook_end
+        board[rook_start] = rook
+        bitboards[rook] |= 1 << rook_start
+        bitboards[side] |= 1 << rook_start
+
+    pos.occupied = bitboards[WHITE] | bitboards[BLACK]
+
+def set_king_square(pos: Position, side: Color, square: Square) -> None:
+
+    if side == WHITE:
+        pos.king_squares = square, pos.king_squares[BLACK]
+    else:
+        pos.king_squares = pos.king_squares[WHITE], square
+
+def play_move(pos: Position, move: Move) -> None:
+    '''
+    Updates the position in place for a legal move. Shared by copy/make
+    and make/unmake so both produce identical positions.
+    '''
+
     # Decode move
     start = move_start(move)
     end = move_end(move)
@@ -353,26 +911,31 @@ def do_move(pos: Position, move: Move) -> Position:
     flag = move_flag(move)
     capture = is_capture(move)
     
-    # New attributes
-    board = [*pos.board]
-    bitboards = [*pos.bitboards]
+    # Attributes to update
+    board = pos.board
+    bitboards = pos.bitboards
     castling = pos.castling
     material_key = pos.material_key
     ep_square = 0
+
+    # Remove side, castling and en passant from the key. They are added
+    # back at the end once the new values are known.
+    key = (pos.key ^ ZOBRIST_SIDE
+           ^ ZOBRIST_CASTLING[castling] ^ ZOBRIST_EP[pos.ep_square])
     
     # For NNUE updating
-    accumulator = [*pos.accumulator]
+    accumulator = pos.accumulator
     dirty_pieces = [(piece, end), (piece, start)]
     
     # Side is side making the move. We will switch sides later
     side = pos.side
     xside = not side
 
-    # Update previous
+    # Update halfmove clock
     if piece & ~0x1 is PAWN or capture:
-        previous = set()
+        rule_50 = 0
     else:
-        previous = {pos.__hash__()}.union(pos.previous)
+        rule_50 = pos.rule_50 + 1
 
     # Remove captured piece
     if capture:
@@ -383,6 +946,7 @@ def do_move(pos: Position, move: Move) -> Position:
             board[ep_pawn_square] = NO_PIECE
             bitboards[ep_pawn] ^= 1 << ep_pawn_square
             bitboards[xside] ^= 1 << ep_pawn_square
+            key ^= ZOBRIST_PIECES[ep_pawn][ep_pawn_square]
             material_key -= MATERIAL_KEYS[ep_pawn]
             dirty_pieces.append((ep_pawn, ep_pawn_square))
         # Regular capture
@@ -390,6 +954,7 @@ def do_move(pos: Position, move: Move) -> Position:
             captured = board[end]
             bitboards[captured] ^= 1 << end
             bitboards[xside] ^= 1 << end
+            key ^= ZOBRIST_PIECES[captured][end]
             material_key -= MATERIAL_KEYS[captured]
             dirty_pieces.append((captured, end))
 
@@ -397,6 +962,7 @@ def do_move(pos: Position, move: Move) -> Position:
     board[start] = NO_PIECE
     bitboards[piece] ^= 1 << start
     bitboards[side] ^= 1 << start
+    key ^= ZOBRIST_PIECES[piece][start]
     material_key -= MATERIAL_KEYS[piece]
     # Place piece on end
     if is_promotion(move):
@@ -405,40 +971,9 @@ def do_move(pos: Position, move: Move) -> Position:
     board[end] = piece
     bitboards[piece] |= 1 << end
     bitboards[side] |= 1 << end
+    key ^= ZOBRIST_PIECES[piece][end]
     material_key += MATERIAL_KEYS[piece]
 
-    # Update accumulator for captures
-    if capture:
-        # Update white accumulation
-        acc = accumulator[WHITE]
-        vec0 = FW_VECTORS[WHITE][dirty_pieces[0]]
-        vec1 = FW_VECTORS[WHITE][dirty_pieces[1]]
-        vec2 = FW_VECTORS[WHITE][dirty_pieces[2]]
-        accumulator[WHITE] = [a + v0 - v1 - v2 for a, v0, v1, v2
-                              in zip(acc, vec0, vec1, vec2)]
-        # Update black accumulation
-        acc = accumulator[BLACK]
-        vec0 = FW_VECTORS[BLACK][dirty_pieces[0]]
-        vec1 = FW_VECTORS[BLACK][dirty_pieces[1]]
-        vec2 = FW_VECTORS[BLACK][dirty_pieces[2]]
-        accumulator[BLACK] = [a + v0 - v1 - v2 for a, v0, v1, v2
-                              in zip(acc, vec0, vec1, vec2)]
-
-    # Update accumulator for normal move
-    else:
-        # Update white accumulation
-        acc = accumulator[WHITE]
-        vec0 = FW_VECTORS[WHITE][dirty_pieces[0]]
-        vec1 = FW_VECTORS[WHITE][dirty_pieces[1]]
-        accumulator[WHITE] = [a + v0 - v1 for a, v0, v1
-                              in zip(acc, vec0, vec1)]
-        # Update black accumulation
-        acc = accumulator[BLACK]
-        vec0 = FW_VECTORS[BLACK][dirty_pieces[0]]
-        vec1 = FW_VECTORS[BLACK][dirty_pieces[1]]
-        accumulator[BLACK] = [a + v0 - v1 for a, v0, v1
-                              in zip(acc, vec0, vec1)]
-
     # Exit early for normal move
     if not flag:
         pass
@@ -449,26 +984,7 @@ def do_move(pos: Position, move: Move) -> Position:
 
     # Castling
     elif flag is CASTLE:
-        # White Kingside castle
-        if end == G1:
-            rook_start = H1
-            rook_end = F1
-            rook = WHITE_ROOK
-        # Black Kingside castle
-        elif end == G8:
-            rook_start = H8
-            rook_end = F8            
-            rook = BLACK_ROOK
-        # White Queenside castle
-        elif end == C1:
-            rook_start = A1
-            rook_end = D1            
-            rook = WHITE_ROOK            
-        # Black Queenside castle
-        elif end == C8:
-            rook_start = A8
-            rook_end = D8
-            rook = BLACK_ROOK
+        rook_start, rook_end, rook = CASTLING_ROOK_MOVES[end]
 
         # Remove rook to rook_start
         board[rook_start] = NO_PIECE
@@ -478,25 +994,96 @@ def do_move(pos: Position, move: Move) -> Position:
         board[rook_end] = rook
         bitboards[rook] |= 1 << rook_end
         bitboards[side] |= 1 << rook_end
+        key ^= ZOBRIST_PIECES[rook][rook_start]
+        key ^= ZOBRIST_PIECES[rook][rook_end]
+
+    # Record the accumulator update, which is only done once an evaluation
+    # needs it. Positions without an accumulator skip NNUE updates.
+    if accumulator is not None:
+        if flag is CASTLE:
+            added = dirty_pieces[0], (rook, rook_end)
+            removed = dirty_pieces[1], (rook, rook_start)
+        else:
+            added = dirty_pieces[0],
+            removed = tuple(dirty_pieces[1:])
+        accumulator = Accumulator(accumulator, added, removed)
 
-        # Update white accumulation
-        acc = accumulator[WHITE]
-        vec0 = FW_VECTORS[WHITE][(rook, rook_end)]
-        vec1 = FW_VECTORS[WHITE][(rook, rook_start)]
-        accumulator[WHITE] = [a + v0 - v1 for a, v0, v1
-                              in zip(acc, vec0, vec1)]
-        # Update black accumulation
-        acc = accumulator[BLACK]
-        vec0 = FW_VECTORS[BLACK][(rook, rook_end)]
-        vec1 = FW_VECTORS[BLACK][(rook, rook_start)]
-        accumulator[BLACK] = [a + v0 - v1 for a, v0, v1
-                              in zip(acc, vec0, vec1)]
-        
     # Update castling rights
     castling &= UPDATE_CASTLING_KEYS[start] & UPDATE_CASTLING_KEYS[end]
-            
-    return Position(board, bitboards, xside,
-                    castling, ep_square, material_key, previous, accumulator)
+    key ^= ZOBRIST_CASTLING[castling] ^ ZOBRIST_EP[ep_square]
+
+    # Record key for repetition detection
+    game_ply = pos.game_ply + 1
+    push_key(pos.key_history, game_ply, key)
+
+    if piece & ~0x1 is KING:
+        set_king_square(pos, side, end)
+
+    pos.occupied = bitboards[WHITE] | bitboards[BLACK]
+    pos.side = xside
+    pos.castling = castling
+    pos.ep_square = ep_square
+    pos.key = key
+    pos.material_key = material_key
+    pos.rule_50 = rule_50
+    pos.game_ply = game_ply
+    pos.accumulator = accumulator
+
+def gives_check(pos: Position, move: Move) -> bool:
+    '''Whether a legal move gives check, without making the move.'''
+
+    check_squares, discoverers = pos.check_info
+
+    start = move_start(move)
+    end = move_end(move)
+    piece = move_piece(move)
+    flag = move_flag(move)
+    side = pos.side
+    king_sq = pos.king_squares[not side]
+
+    # Direct check
+    if flag < WHITE_KNIGHT and check_squares[piece & ~0x1] & (1 << end):
+        return True
+
+    # Discovered check
+    if discoverers & (1 << start) and not LINES[start][king_sq] & (1 << end):
+        return True
+
+    # Normal moves and double pawn pushes are done
+    if flag is NO_FLAG or flag is DOUBLE:
+        return False
+
+    bitboards = pos.bitboards
+
+    # Promoted piece attacks the king through the vacated start square
+    if flag >= WHITE_KNIGHT:
+        occupied = pos.occupied ^ (1 << start)
+        promotion = flag & ~0x1
+        if promotion is KNIGHT:
+            return bool(KNIGHT_ATTACKS[end] & (1 << king_sq))
+        if promotion is BISHOP:
+            return bool(bishop_attacks(end, occupied) & (1 << king_sq))
+        if promotion is ROOK:
+            return bool(rook_attacks(end, occupied) & (1 << king_sq))
+        return bool(queen_attacks(end, occupied) & (1 << king_sq))
+
+    # En passant can discover a check through the captured pawn
+    if flag is ENPASSANT:
+        captured_sq = end + (SOUTH if side == WHITE else NORTH)
+        occupied = (pos.occupied ^ (1 << start) ^ (1 << captured_sq)
+                    | (1 << end))
+        return bool(
+            rook_attacks(king_sq, occupied)
+            & (bitboards[ROOK + side] | bitboards[QUEEN + side])
+            | bishop_attacks(king_sq, occupied)
+            & (bitboards[BISHOP + side] | bitboards[QUEEN + side])
+        )
+
+    # Castling checks with the rook
+    rook_start, rook_end, _ = CASTLING_ROOK_MOVES[end]
+    occupied = (pos.occupied ^ (1 << start) ^ (1 << rook_start)
+                | (1 << end) | (1 << rook_end))
+    return bool(rook_attacks(rook_end, occupied) & (1 << king_sq))
 
 def see(pos: Position, move: Move, max=max):
     '''Static exchange evaluation.'''
@@ -522,22 +1109,7 @@ def see(pos: Position, move: Move, max=max):
     start = move_start(move)
 
     # Initial attackers to square
-    attackers = (
-        (PAWN_ATTACKS[WHITE][end] & bitboards[BLACK_PAWN]) |
-        (PAWN_ATTACKS[BLACK][end] & bitboards[WHITE_PAWN]) |
-        (KING_ATTACKS[end] & (bitboards[WHITE_KING] |
-                              bitboards[BLACK_KING])) |
-        (KNIGHT_ATTACKS[end] & (bitboards[WHITE_KNIGHT] |
-                                bitboards[BLACK_KNIGHT])) |
-        (rook_attacks(end, occupied) & (bitboards[WHITE_ROOK] |
-                                        bitboards[BLACK_ROOK] |
-                                        bitboards[WHITE_QUEEN] |
-                                        bitboards[BLACK_QUEEN])) |
-        (bishop_attacks(end, occupied) & (bitboards[WHITE_QUEEN] |
-                                          bitboards[BLACK_QUEEN] |
-                                          bitboards[WHITE_BISHOP] |
-                                          bitboards[BLACK_BISHOP]))
-    )
+    attackers = pos.attackers_to(end)
     
     attacked_value = PIECE_VALUES[
         PAWN if flag is ENPASSANT else board[end]
@@ -622,3 +1194,105 @@ def see(pos: Position, move: Move, max=max):
         gain[count - 1] = -max(-gain[count - 1], gain[count])
         
     return gain[0]
+
+def see_ge(pos: Position, move: Move, threshold: Value) -> bool:
+    '''
+    Whether the static exchange evaluation of a move is at least
+    threshold. Stops as soon as the outcome is decided, so quiet moves to
+    unattacked squares only cost an attack test.
+    '''
+
+    flag = move_flag(move)
+
+    if flag is CASTLE:
+        return threshold <= 0
+
+    board = pos.board
+    start = move_start(move)
+    end = move_end(move)
+    piece = board[start]
+
+    if piece & ~0x1 is KING and not is_capture(move):
+        return threshold <= 0
+
+    # Fails even if the captured piece is not recaptured
+    swap = PIECE_VALUES[PAWN if flag is ENPASSANT else board[end]] - threshold
+    if swap < 0:
+        return False
+
+    # Succeeds even if the moved piece is lost for nothing
+    swap = PIECE_VALUES[piece] - swap
+    if swap <= 0:
+        return True
+
+    side = pos.side
+    bitboards = pos.bitboards
+    occupied = pos.occupied ^ (1 << start)
+    if flag is ENPASSANT:
+        occupied ^= 1 << (end + (SOUTH if side == WHITE else NORTH))
+
+    attackers = pos.attackers_to(end)
+
+    # Recalculate attackers in case of an x-ray attack. Pawn pushes and
+    # en passant open the file behind the pawn as well.
+    if piece & ~0x1 in (PAWN, BISHOP, QUEEN):
+        attackers |= (
+            bishop_attacks(end, occupied) & (bitboards[WHITE_QUEEN] |
+                                             bitboards[BLACK_QUEEN] |
+                                             bitboards[WHITE_BISHOP] |
+                                             bitboards[BLACK_BISHOP])
+        )
+    if piece & ~0x1 in (PAWN, ROOK, QUEEN):
+        attackers |= (
+            rook_attacks(end, occupied) & (bitboards[WHITE_ROOK] |
+                                           bitboards[BLACK_ROOK] |
+                                           bitboards[WHITE_QUEEN] |
+                                           bitboards[BLACK_QUEEN])
+        )
+
+    # Whether the side that made the last capture gets at least threshold
+    result = True
+
+    while True:
+        side = not side
+        attackers &= occupied
+        side_attackers = attackers & bitboards[side]
+        if not side_attackers:
+            break
+
+        result = not result
+
+        # Least valuable attacker
+        for piece in PIECES[PAWN + side::2]:
+            attacked = bitboards[piece] & side_attackers
+            if attacked:
+                break
+
+        # The king can only capture if nothing recaptures
+        if piece & ~0x1 is KING:
+            return (not result) if attackers & ~bitboards[side] else result
+
+        # Stop if the side to capture is still behind after taking
+        swap = PIECE_VALUES[piece] - swap
+        if swap < result:
+            break
+
+        occupied ^= attacked & -attacked
+
+        # Recalculate attackers in case of an x-ray attack
+        if piece & ~0x1 in (PAWN, BISHOP, QUEEN):
+            attackers |= (
+                bishop_attacks(end, occupied) & (bitboards[WHITE_QUEEN] |
+                                                 bitboards[BLACK_QUEEN] |
+                                                 bitboards[WHITE_BISHOP] |
+                                                 bitboards[BLACK_BISHOP])
+            )
+        if piece & ~0x1 in (ROOK, QUEEN):
+            attackers |= (
+                rook_attacks(end, occupied) & (bitboards[WHITE_ROOK] |
+                                               bitboards[BLACK_ROOK] |
+                                               bitboards[WHITE_QUEEN] |
+                                               bitboards[BLACK_QUEEN])
+            )
+
+    return result
@@ -17,26 +17,64 @@ DELTA_CUTOFF = 150
 SEE_PRUNE_CUTOFF = 20
 SEE_PRUNE_CAPTURE_CUTOFF = 90
 
-LMR = zeros(MAX_PLY, 64)
-STATIC_PRUNE = zeros(2, MAX_PLY)
-
-# Late move reduction table
-for depth in range(1, MAX_PLY):
-    for moves in range(1, 64):
-        LMR[depth][moves] = int(0.8 + log(depth) * log(1.2 * moves) / 2.5)
+# Late move reduction table. Built directly rather than filling zeros(),
+# which deep copies every row.
+LMR = [
+    [int(0.8 + log(depth) * log(1.2 * moves) / 2.5) if depth and moves else 0
+     for moves in range(64)]
+    for depth in range(MAX_PLY)
+]
 
 # Initialize pruning tables 
-for depth in range(MAX_PLY):
-    STATIC_PRUNE[0][depth] = -SEE_PRUNE_CUTOFF * depth * depth
-    STATIC_PRUNE[1][depth] = -SEE_PRUNE_CAPTURE_CUTOFF * depth
+STATIC_PRUNE = [
+    [-SEE_PRUNE_CUTOFF * depth * depth for depth in range(MAX_PLY)],
+    [-SEE_PRUNE_CAPTURE_CUTOFF * depth for depth in range(MAX_PLY)],
+]
+
+def set_make_unmake(enabled: bool) -> None:
+    '''
+    Switches the search between copy/make, which creates a new position
+    for every move, and make/unmake, which updates one position in place
+    and takes the move back afterwards. Both search identical trees.
+    '''
+
+    global make, make_null, unmake
+
+    if enabled:
+        make, make_null, unmake = apply_move, apply_null_move, undo_move
+    else:
+        make, make_null, unmake = do_move, do_null_move, keep_position
+
+def keep_position(pos: Position) -> None:
+    '''Nothing to take back with copy/make.'''
+
+set_make_unmake(False)
+
+def set_pseudo_legal(enabled: bool) -> None:
+    '''
+    Switches move generation between strictly legal and pseudo-legal.
+    Pseudo-legal moves are checked with is_pseudo_legal_move_legal only
+    when the search reaches them, so nodes that cut off early never pay
+    for pins. Both search identical trees.
+    '''
+
+    global pseudo_legal
+
+    pseudo_legal = enabled
+
+set_pseudo_legal(False)
+
+def init_thread(thread_no: int, shared: SharedMemory) -> None:
 
-def spin(thread_no: int, shared: SharedMemory) -> None:
-    
     global MAIN_THREAD, search_flag, tt 
     
     MAIN_THREAD = thread_no == 0
     search_flag = shared.search_flag
     tt = shared.tt
+
+def spin(thread_no: int, shared: SharedMemory) -> None:
+    
+    init_thread(thread_no, shared)
     
     data = SearchData()
 
@@ -69,6 +107,7 @@ def search(shared: SharedMemory, data: SearchData) -> None:
     data.stack = Stack()
 
     pos = shared.pos
+    refresh_accumulator(pos)
     alpha = -CHECKMATE
     beta = CHECKMATE
     value = 0
@@ -192,6 +231,13 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
         # Draw
         if pos.is_material_draw or pos.is_repeated or pos.rule_50 > 99:
             return 2 - (data.nodes & 0x3)
+        # Upcoming repetition: we can force a draw
+        if alpha < 0 and pos.has_upcoming_repetition(stack.ply):
+            alpha = 2 - (data.nodes & 0x3)
+            if alpha >= beta:
+                return alpha
+            # Bound the stored value by the draw score
+            old_alpha = alpha
         # Prevent overflow
         if stack.ply >= MAX_PLY:
             return evaluate(pos)
@@ -238,7 +284,7 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
     stack[1].killers[1] = NULL_MOVE
 
     # Init move picker
-    mp = MovePicker(pos, data)
+    mp = MovePicker(pos, data, pseudo_legal)
 
     if not is_pv and not in_check:
 
@@ -267,8 +313,9 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
             # Do null move reduced depth search
             stack[0].move = NULL_MOVE
             stack.ply += 1
-            value = -negamax(do_null_move(pos), -beta, -beta + 1,
+            value = -negamax(make_null(pos), -beta, -beta + 1,
                              depth - r, not cut_node, data, child_pv)
+            unmake(pos)
             stack.ply -= 1
             # Cutoff if fails high
             if value >= beta:
@@ -284,10 +331,13 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
             for move in mp(quiescence=True):
                 if move is excluded:
                     continue
+                if (pseudo_legal
+                    and not is_pseudo_legal_move_legal(pos, move)):
+                    continue
                 # Do a quiescence search
                 stack[0].move = move
                 stack.ply += 1
-                new_pos = do_move(pos, move)
+                new_pos = make(pos, move)
                 value = -quiescence(new_pos, -prob_beta,
                                     -prob_beta + 1, data, pv)
                 # Quiescence search failed high so the move might be
@@ -296,6 +346,7 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
                 if value >= prob_beta:
                     value = -negamax(new_pos, -prob_beta, -prob_beta + 1,
                                      depth - 4, not cut_node, data, pv)
+                unmake(pos)
                 stack.ply -= 1
                 # Cutoff if fails high
                 if value >= prob_beta:
@@ -313,6 +364,10 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
     for move in mp(tt_move=tt_move):
         if move is excluded:
             continue
+        if (pseudo_legal
+            and not in_check
+            and not is_pseudo_legal_move_legal(pos, move)):
+            continue
 
         tactical = is_tactical(move)
 
@@ -325,7 +380,7 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
         
         if not tactical:
             counter_history = get_counter_history(data, move)
-            quiet_history = get_quiet_history(pos, data, move)
+            quiet_history = mp.quiet_history
             special_quiet = move in (mp.k1, mp.k2, mp.counter)
         else:
             counter_history = 0
@@ -351,12 +406,12 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
                 continue
             # Quiet SEE pruning    
             if (not tactical
-                and see(pos, move) < STATIC_PRUNE[0][depth]):
+                and not see_ge(pos, move, STATIC_PRUNE[0][depth])):
                 continue
             # Tactical SEE pruning
             if (tactical
                 and mp.phase > PLAY_GOOD_TACTICALS
-                and see(pos, move) < STATIC_PRUNE[1][depth]):
+                and not see_ge(pos, move, STATIC_PRUNE[1][depth])):
                 continue
 
         non_pruned_count += 1
@@ -405,11 +460,6 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
               and move_end(move) == move_end(stack[-1].move)):
             extension = 1
 
-        # Do move
-        stack[0].move = move
-        stack.ply += 1
-        new_pos = do_move(pos, move)
-
         # Apply extensions
         new_depth = depth + max(extension, (in_check and depth < 7))
         
@@ -427,7 +477,7 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
                     r += 1
                 if special_quiet:
                     r -= 2
-                if new_pos.in_check:
+                if gives_check(pos, move):
                     r -= 1                    
                 r -= quiet_history // 20480
             # Tactical reduction
@@ -437,6 +487,11 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
             # Make sure we don't reduce or extend too much
             r = min(depth - 1, max(r, 1))
 
+        # Do move
+        stack[0].move = move
+        stack.ply += 1
+        new_pos = make(pos, move)
+
         # PVS
         if is_pv and non_pruned_count == 1:
             value = -negamax(new_pos, -beta, -alpha,
@@ -455,6 +510,7 @@ def negamax(pos: Position, alpha: Value, beta: Value, depth: int,
                 value = -negamax(new_pos, -beta, -alpha,
                                  new_depth - 1, False, data, child_pv)
                 
+        unmake(pos)
         stack.ply -= 1
 
         # Regular negamax stuff
@@ -519,6 +575,12 @@ def quiescence(pos: Position, alpha: Value, beta: Value,
     if pos.is_material_draw or pos.is_repeated or pos.rule_50 > 99:
         return 0
 
+    # Upcoming repetition: we can force a draw
+    if alpha < 0 and pos.has_upcoming_repetition(stack.ply):
+        alpha = 0
+        if alpha >= beta:
+            return alpha
+
     # Prevent overflow
     if stack.ply >= MAX_PLY:
         return evaluate(pos)
@@ -559,18 +621,23 @@ def quiescence(pos: Position, alpha: Value, beta: Value,
         best_value = evaluation
 
     # Initialize move picker and SEE cutoff
-    mp = MovePicker(pos, data)
+    mp = MovePicker(pos, data, pseudo_legal)
     see_cutoff = max(0, alpha - evaluation - DELTA_CUTOFF)
     
     # Loop through only good tacticals
     for move in mp(quiescence=True, cutoff=see_cutoff):
         if not in_check and mp.phase > PLAY_GOOD_TACTICALS:
             break
+        if (pseudo_legal
+            and not in_check
+            and not is_pseudo_legal_move_legal(pos, move)):
+            continue
 
         # Do the move
         stack[0].move = move
         stack.ply += 1
-        value = -quiescence(do_move(pos, move), -beta, -alpha, data, child_pv)
+        value = -quiescence(make(pos, move), -beta, -alpha, data, child_pv)
+        unmake(pos)
         stack.ply -= 1
 
         # Regular quiescence search stuff
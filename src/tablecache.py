@@ -0,0 +1,113 @@
+'''
+On-disk cache for precomputed tables. Tables are stored with marshal in
+a __tablecache__ directory next to the sources so that starting the
+engine, and every worker process it spawns, only has to load them. A
+cache file is rebuilt when it is missing, fails its checksum or was
+written by a different version of the engine, of the module that
+builds the tables or of a module the tables depend on.
+'''
+
+import marshal
+import os
+import struct
+import sys
+import zlib
+from typing import Any, Callable, Iterable
+
+from defs import VERSION
+
+CACHE_FORMAT = 1
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '__tablecache__')
+
+# Magic, cache format, engine version, crc32 of the sources of the
+# building module and its dependencies, and crc32 of the payload
+HEADER = struct.Struct('<4sI16sII')
+MAGIC = b'DHTC'
+
+def cache_path(name: str) -> str:
+    return os.path.join(CACHE_DIR, f'{name}.bin')
+
+def source_crc(module_names: Iterable[str]) -> int:
+    '''Checksum of the sources of the modules, in order.'''
+
+    crc = 0
+
+    for module_name in module_names:
+        try:
+            with open(sys.modules[module_name].__file__, 'rb') as f:
+                crc = zlib.crc32(f.read(), crc)
+        except (AttributeError, KeyError, OSError, TypeError):
+            return 0
+
+    return crc
+
+def load_tables(name: str, source: int) -> Any:
+    '''Loads cached tables, or returns None if the cache is not usable.'''
+
+    try:
+        with open(cache_path(name), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    if len(data) < HEADER.size:
+        return None
+
+    magic, fmt, version, source_check, payload_check = HEADER.unpack_from(data)
+    payload = memoryview(data)[HEADER.size:]
+
+    if (magic != MAGIC
+        or fmt != CACHE_FORMAT
+        or version.rstrip(b'\0') != VERSION.encode()
+        or source_check != source
+        or payload_check != zlib.crc32(payload)):
+        return None
+
+    try:
+        return marshal.loads(payload)
+    except (EOFError, ValueError, TypeError):
+        return None
+
+def save_tables(name: str, source: int, tables: Any) -> None:
+    '''
+    Writes tables to the cache. The file is written under a temporary
+    name and moved into place so processes starting at the same time
+    never read half a file. Failing to write, e.g. on a read-only
+    install, only means the tables are built again next time.
+    '''
+
+    payload = marshal.dumps(tables)
+    header = HEADER.pack(MAGIC, CACHE_FORMAT, VERSION.encode(),
+                         source, zlib.crc32(payload))
+    path = cache_path(name)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+def cached_tables(name: str, build: Callable[[], Any],
+                  dependencies: Iterable[str]=()) -> Any:
+    '''
+    Returns the tables made by build, from the cache if possible.
+    dependencies names the modules whose code or constants end up in the
+    tables, besides the module of build.
+    '''
+
+    source = source_crc((build.__module__, *dependencies))
+    tables = load_tables(name, source)
+
+    if tables is None:
+        tables = build()
+        save_tables(name, source, tables)
+
+    return tables
@@ -26,7 +26,7 @@ def make_tt(mb: int) -> None:
 def tt_get(tt: TT, pos: Position) -> TTEntry:
     '''Gets entry from transposition table.'''
 
-    key = pos.__hash__()
+    key = pos.key
     short_key = key >> 45
     entry_llong = tt[key % len(tt)]
 
@@ -50,7 +50,7 @@ def tt_put(tt: TT, pos: Position,
     bits [18-00] short_key
     '''
 
-    key = pos.__hash__()
+    key = pos.key
     short_key = key >> 45
     index = key % len(tt)
     entry_llong = tt[index]
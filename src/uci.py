@@ -13,6 +13,9 @@ def print_options():
     print('option name Hash type spin default 32 min 4 max 4096')
     print('option name Clear Hash type button')
     print('option name OnlineSyzygy type check default false')
+    print(f'option name NNUEBackend type combo '
+          f'default {DEFAULT_NNUE_BACKEND} '
+          + ' '.join(f'var {name}' for name in NNUE_BACKENDS))
     print('uciok')
         
 def uci_loop() -> None:
@@ -70,6 +73,15 @@ def uci_loop() -> None:
                 print(f'info string Online Syzygy Tablebase '
                       f'Probing set to {online_syzygy}')
 
+            # NNUE backend. Workers are restarted to pick it up.
+            if 'setoption name NNUEBackend value' in string:
+                try:
+                    set_nnue_backend(tokens[-1])
+                    init_pool(pool, threads, spin, shared, tt)
+                    print(f'info string NNUE backend set to {tokens[-1]}')
+                except (ImportError, ValueError) as e:
+                    print(f'info string NNUE backend unchanged: {e}')
+
         if string == 'ucinewgame':
             tt = make_tt(mb)
             init_pool(pool, threads, spin, shared, tt)